@@ -5,305 +5,2619 @@ import json
 import shutil
 import subprocess
 import argparse
-import psutil
-import requests
+import importlib.util
 import threading
 import enum
 import sys
-import zipfile
-import tempfile
+import gzip
+import collections
+import fnmatch
+import heapq
+import socket
+import urllib.parse
+import array
+import math
+import functools
+import re
+import random
 from dotenv import load_dotenv
+
+def lazy_import(name):
+    """Module whose real import is deferred to its first attribute access"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+# Heavy third-party modules; --task runs that never touch them never pay for them
+psutil = lazy_import("psutil")
+requests = lazy_import("requests")
 from pathlib import Path
 from datetime import datetime
 
-# Agent version - increment this when updating
-AGENT_VERSION = "1.0.0"
+# Agent version - increment this when updating
+AGENT_VERSION = "1.0.0"
+
+class TaskStatus(str, enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+load_dotenv(dotenv_path=Path(__file__).with_name(".env"))
+
+SERVER_URL = os.getenv("SERVER_URL", "http://127.0.0.1:8000")
+DEVICE_KEY = os.getenv("DEVICE_KEY", "CHANGE_ME_DEVICE_KEY")
+DEVICE_NAME = os.getenv("DEVICE_NAME", "New Device")
+BANDWIDTH_PROBE_INTERVAL = int(os.getenv("BANDWIDTH_PROBE_INTERVAL", "3600"))
+BANDWIDTH_PROBE_TTL = int(os.getenv("BANDWIDTH_PROBE_TTL", "7200"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "15"))
+HTTP_GZIP = os.getenv("HTTP_GZIP", "1") == "1"
+TASK_WORKERS = int(os.getenv("TASK_WORKERS", "2"))
+TASK_TIMEOUT = int(os.getenv("TASK_TIMEOUT", "600"))
+TASK_PROGRESS_INTERVAL = float(os.getenv("TASK_PROGRESS_INTERVAL", "2"))  # Seconds between progress uploads
+TASK_PROGRESS_MAX_EVENTS = int(os.getenv("TASK_PROGRESS_MAX_EVENTS", "200"))  # Buffered; oldest dropped beyond
+TASK_RESULT_MAX_BYTES = int(os.getenv("TASK_RESULT_MAX_BYTES", str(256 * 1024)))  # Longer output is trimmed
+TASK_RESULT_CHUNK_BYTES = int(os.getenv("TASK_RESULT_CHUNK_BYTES", str(32 * 1024)))  # Per request
+# Polling is only the fallback when the server has no task stream
+TASK_POLL_MIN = int(os.getenv("TASK_POLL_MIN", "5"))
+TASK_POLL_MAX = int(os.getenv("TASK_POLL_MAX", "120"))
+TASK_STREAM_TIMEOUT = int(os.getenv("TASK_STREAM_TIMEOUT", "90"))  # Server heartbeats well within this
+TASK_STREAM_RETRY = int(os.getenv("TASK_STREAM_RETRY", "600"))  # Re-probe for a stream while polling
+SAMPLE_PERIOD = float(os.getenv("SAMPLE_PERIOD", "1"))  # Local sampling, independent of uploads
+SAMPLE_BUFFER = int(os.getenv("SAMPLE_BUFFER", "3600"))  # Samples kept per metric
+GPU_SAMPLE_MS = int(os.getenv("GPU_SAMPLE_MS", "1000"))
+NETWORK_PROBE_TARGETS = [t.strip() for t in os.getenv(
+    "NETWORK_PROBE_TARGETS", "https://one.one.one.one,https://dns.google,https://dns.quad9.net").split(",") if t.strip()]
+NETWORK_PROBE_SAMPLES = int(os.getenv("NETWORK_PROBE_SAMPLES", "5"))
+NETWORK_PROBE_TIMEOUT = float(os.getenv("NETWORK_PROBE_TIMEOUT", "5"))
+TOP_PROCESSES = int(os.getenv("TOP_PROCESSES", "5"))
+MEMORY_TRACK_MAX = int(os.getenv("MEMORY_TRACK_MAX", "1024"))  # Processes with a memory history
+MEMORY_TRACK_MIN_MB = float(os.getenv("MEMORY_TRACK_MIN_MB", "50"))  # Smaller processes are not tracked
+MEMORY_HISTORY_POINTS = int(os.getenv("MEMORY_HISTORY_POINTS", "64"))  # Points kept per process
+LEAK_MIN_HOURS = float(os.getenv("LEAK_MIN_HOURS", "1"))  # History needed before flagging a leak
+LEAK_MIN_MB_PER_HOUR = float(os.getenv("LEAK_MIN_MB_PER_HOUR", "10"))
+LEAK_MIN_R2 = float(os.getenv("LEAK_MIN_R2", "0.8"))  # How steady the growth must be
+PROCFS_BACKEND = os.getenv("PROCFS_BACKEND", "1") == "1"  # Linux: sample from /proc directly
+# e.g. "processes=30,partitions=1200" to change how often a collector runs
+COLLECTOR_INTERVALS = {
+    name.strip(): float(value)
+    for name, _, value in (item.partition("=") for item in os.getenv("COLLECTOR_INTERVALS", "").split(","))
+    if value.strip()
+}
+CLEANUP_WORKERS = int(os.getenv("CLEANUP_WORKERS", "8"))
+CLEANUP_MIN_AGE = float(os.getenv("CLEANUP_MIN_AGE_HOURS", "0")) * 3600
+CLEANUP_DRY_RUN = os.getenv("CLEANUP_DRY_RUN", "0") == "1"
+SELF_METRICS = os.getenv("SELF_METRICS", "0") == "1"
+SELF_METRICS_PORT = int(os.getenv("SELF_METRICS_PORT", "9464"))
+SELF_METRICS_IN_PAYLOAD = os.getenv("SELF_METRICS_IN_PAYLOAD", "0") == "1"
+IDENTITY_PATH = Path(__file__).with_name("identity.json")
+SPOOL_PATH = os.getenv("SPOOL_PATH", str(Path(__file__).with_name("spool.db")))
+SPOOL_MAX_SAMPLES = int(os.getenv("SPOOL_MAX_SAMPLES", "20000"))
+SPOOL_MAX_MB = float(os.getenv("SPOOL_MAX_MB", "50"))
+SPOOL_MAX_AGE = int(os.getenv("SPOOL_MAX_AGE", str(7 * 24 * 3600)))
+SPOOL_BATCH_SIZE = int(os.getenv("SPOOL_BATCH_SIZE", "200"))
+SPOOL_MAX_BATCHES = int(os.getenv("SPOOL_MAX_BATCHES", "5"))  # Per cycle, caps catch-up rate
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "1") == "1"  # Keep a local copy of every sample
+HISTORY_PATH = os.getenv("HISTORY_PATH", str(Path(__file__).with_name("history.db")))
+HISTORY_MAX_MB = float(os.getenv("HISTORY_MAX_MB", "100"))
+# Seconds each tier is kept: raw samples, 1-minute and 1-hour rollups
+HISTORY_RETENTION = {
+    "raw": int(os.getenv("HISTORY_RAW_SECONDS", str(3600))),
+    "minute": int(os.getenv("HISTORY_MINUTE_SECONDS", str(7 * 24 * 3600))),
+    "hour": int(os.getenv("HISTORY_HOUR_SECONDS", str(90 * 24 * 3600))),
+}
+# Upload retries are independent of the sampling interval
+BACKOFF_BASE = float(os.getenv("BACKOFF_BASE", "10"))
+BACKOFF_MAX = float(os.getenv("BACKOFF_MAX", "300"))
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "4"))  # Consecutive failures that open the circuit
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "300"))
+# Random delay before the first upload; defaults to the sampling interval
+STARTUP_SPLAY = float(os.getenv("STARTUP_SPLAY")) if os.getenv("STARTUP_SPLAY") else None
+POLICY_ENABLED = os.getenv("POLICY_ENABLED", "1") == "1"  # Let the server change settings at run time
+POLICY_REFRESH = int(os.getenv("POLICY_REFRESH", "300"))  # Seconds between policy checks
+POLICY_PATH = Path(__file__).with_name("policy.json")
+ADAPTIVE_ENABLED = os.getenv("ADAPTIVE_ENABLED", "1") == "1"  # Slow down while idle, speed up around spikes
+ADAPTIVE_IDLE_INTERVAL = float(os.getenv("ADAPTIVE_IDLE_INTERVAL", "300"))  # Upload interval while idle
+ADAPTIVE_IDLE_AFTER = float(os.getenv("ADAPTIVE_IDLE_AFTER", "600"))  # Seconds of flat readings before idling
+ADAPTIVE_BURST_INTERVAL = float(os.getenv("ADAPTIVE_BURST_INTERVAL", "5"))  # Upload interval after a spike
+ADAPTIVE_BURST_SECONDS = float(os.getenv("ADAPTIVE_BURST_SECONDS", "120"))  # Burst lasts this long past the last spike
+ADAPTIVE_BURST_MAX = float(os.getenv("ADAPTIVE_BURST_MAX", "600"))  # Longest burst; then a cooldown
+ADAPTIVE_Z = float(os.getenv("ADAPTIVE_Z", "4"))  # Spike threshold in standard deviations
+ADAPTIVE_HEADLESS_AWAY = os.getenv("ADAPTIVE_HEADLESS_AWAY", "0") == "1"  # No readable user input counts as away
+PAYLOAD_FORMAT = os.getenv("PAYLOAD_FORMAT", "json")  # "delta" sends keyframes plus changed fields only
+PAYLOAD_KEYFRAME_EVERY = int(os.getenv("PAYLOAD_KEYFRAME_EVERY", "30"))
+
+def win():
+    return os.name == "nt"
+
+# -------- Self Instrumentation --------
+class Histogram:
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+class AgentMetrics:
+    """The agent's own costs, exported in Prometheus text format; no-ops when disabled"""
+
+    HELP = {
+        "agent_collector_seconds": ("histogram", "Time spent in each collector"),
+        "agent_collect_seconds": ("histogram", "Time spent in collect_metrics"),
+        "agent_http_request_seconds": ("histogram", "Server request latency by endpoint"),
+        "agent_http_failures_total": ("counter", "Failed server requests by endpoint"),
+        "agent_task_seconds": ("histogram", "Task run time by type and outcome"),
+        "agent_task_poll_seconds": ("histogram", "Time spent polling for tasks"),
+        "agent_uploads_total": ("counter", "Upload cycles by outcome"),
+        "agent_collect_failures_total": ("counter", "Samples lost to collection errors"),
+        "agent_backoff_seconds": ("gauge", "Seconds until the server may be contacted again"),
+        "agent_circuit_open": ("gauge", "1 while the circuit breaker holds off server calls"),
+        "agent_policy_updates_total": ("counter", "Server policy changes applied"),
+        "agent_cadence_switches_total": ("counter", "Sampling mode changes by new mode"),
+        "agent_upload_interval_seconds": ("gauge", "Current upload interval"),
+        "agent_spool_depth": ("gauge", "Samples waiting in the local spool"),
+        "agent_cpu_percent": ("gauge", "Agent process CPU usage"),
+        "agent_rss_bytes": ("gauge", "Agent process resident memory"),
+    }
+
+    def __init__(self, enabled=SELF_METRICS):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.series = {}  # (name, labels) -> Histogram, counter or gauge value
+        self.gauge_fns = {}  # name -> callable, read at scrape time
+        self.process = None
+        self.server = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.series.get(key)
+            if hist is None:
+                hist = self.series[key] = Histogram()
+            hist.observe(seconds)
+
+    def inc(self, name, by=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + by
+
+    def set(self, name, value, **labels):
+        if self.enabled:
+            self.series[self._key(name, labels)] = value
+
+    def gauge(self, name, fn):
+        self.gauge_fns[name] = fn
+
+    def timed(self, name):
+        """Decorator recording a function's run time as a histogram"""
+        def wrap(fn):
+            @functools.wraps(fn)
+            def inner(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start)
+            return inner
+        return wrap
+
+    def _read_gauges(self):
+        if self.process is None:
+            self.process = psutil.Process()
+            self.process.cpu_percent(None)
+        values = {
+            "agent_cpu_percent": self.process.cpu_percent(None),
+            "agent_rss_bytes": self.process.memory_info().rss,
+        }
+        for name, fn in self.gauge_fns.items():
+            try:
+                values[name] = fn()
+            except Exception:
+                pass
+        return values
+
+    def render(self):
+        """All series in Prometheus text exposition format"""
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        with self.lock:
+            series = dict(self.series)
+            for name, value in self._read_gauges().items():
+                series[(name, ())] = value
+        lines = []
+        for name in sorted({name for name, _ in series}):
+            kind, help_text = self.HELP.get(name, ("gauge", name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (series_name, labels), value in sorted(series.items(), key=lambda kv: kv[0]):
+                if series_name != name:
+                    continue
+                if isinstance(value, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(value.BUCKETS, value.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {value.count}")
+                    lines.append(f"{name}_sum{fmt(labels)} {value.sum}")
+                    lines.append(f"{name}_count{fmt(labels)} {value.count}")
+                else:
+                    lines.append(f"{name}{fmt(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Compact view attached to the payload's extra"""
+        gauges = self._read_gauges()
+        return {
+            "cpu_percent": round(gauges["agent_cpu_percent"], 2),
+            "rss_mb": round(gauges["agent_rss_bytes"] / (1024**2), 1),
+            "spool_depth": gauges.get("agent_spool_depth"),
+            "backoff_s": self.series.get(("agent_backoff_seconds", ())),
+            "collector_ms": {name: round(c.last_ms, 2) for name, c in COLLECTORS.items()},
+        }
+
+    def serve(self, port=SELF_METRICS_PORT):
+        """Expose /metrics on localhost only"""
+        if not self.enabled or self.server:
+            return
+        import http.server
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"✓ Agent metrics on http://127.0.0.1:{port}/metrics")
+
+METRICS = AgentMetrics()
+
+# -------- Server Transport --------
+class Transport:
+    """Shared keep-alive session for every call to the server"""
+
+    GZIP_MIN_BYTES = 512  # Smaller bodies are not worth compressing
+
+    def __init__(self, base_url, device_key, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                 compress=HTTP_GZIP, pool_size=4):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.compress = compress
+        self.pool_size = pool_size
+        self.device_key = device_key
+        self.missing = set()  # Optional endpoints this server answered 404/405 for
+        self._session = None
+
+    def supports(self, endpoint):
+        """False once the server has shown it lacks an optional endpoint; use the older API then"""
+        return endpoint not in self.missing
+
+    def mark_missing(self, endpoint):
+        self.missing.add(endpoint)
+
+    @property
+    def session(self):
+        """Created on first use, so importing the agent does not load requests"""
+        if self._session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["User-Agent"] = f"health-agent/{AGENT_VERSION}"
+            session.headers["X-Device-Key"] = self.device_key
+            self._session = session
+        return self._session
+
+    def set_device_key(self, device_key):
+        self.device_key = device_key
+        if self._session is not None:
+            self._session.headers["X-Device-Key"] = device_key
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if not METRICS.enabled:
+            return self.session.request(method, self.base_url + path, **kwargs)
+        # Label by route, not by device or task ID
+        endpoint = re.sub(r"/\d+", "/{id}", path.split("?")[0])
+        start = time.perf_counter()
+        try:
+            r = self.session.request(method, self.base_url + path, **kwargs)
+        except Exception as e:
+            METRICS.inc("agent_http_failures_total", method=method, endpoint=endpoint, reason=type(e).__name__)
+            raise
+        finally:
+            METRICS.observe("agent_http_request_seconds", time.perf_counter() - start,
+                            method=method, endpoint=endpoint)
+        if r.status_code >= 400:
+            METRICS.inc("agent_http_failures_total", method=method, endpoint=endpoint, reason=r.status_code)
+        return r
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def post_json(self, path, payload, content_type="application/json"):
+        """POST a JSON body, gzip-compressed when the server accepts it"""
+        body = json.dumps(payload, separators=(",", ":")).encode()
+        headers = {"Content-Type": content_type}
+        if self.compress and len(body) >= self.GZIP_MIN_BYTES:
+            r = self.post(path, data=gzip.compress(body, compresslevel=6),
+                          headers={**headers, "Content-Encoding": "gzip"})
+            if r.status_code != 415:
+                return r
+            # Server does not understand compressed bodies; stop trying
+            self.compress = False
+        return self.post(path, data=body, headers=headers)
+
+TRANSPORT = Transport(SERVER_URL, DEVICE_KEY)
+
+# -------- Retry Policy --------
+class UploadFailed(Exception):
+    """A server call failed; carries the server's Retry-After, if any"""
+
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.retry_after = retry_after(response) if response is not None else None
+
+def retry_after(response, limit=3600):
+    """Seconds from a Retry-After header (delta-seconds or HTTP date), capped at limit"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        import email.utils
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), limit)
+
+class ServerBackoff:
+    """Full-jitter exponential backoff with a circuit breaker, shared by all server calls"""
+
+    def __init__(self, base=BACKOFF_BASE, cap=BACKOFF_MAX, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.base = base
+        self.cap = cap
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.not_before = 0.0
+        self.state = "closed"  # closed -> open after threshold failures -> half-open (one probe) -> closed
+
+    def ready(self, now=None):
+        """Whether the server may be called now; while half-open only the single probe gets through"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if now < self.not_before or self.state == "half-open":
+                return False
+            if self.state == "open":
+                self.state = "half-open"
+            return True
+
+    def remaining(self, now=None):
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.not_before - now)
+
+    def paused(self, now=None):
+        """Backing off or not yet closed again; unlike ready(), never takes the half-open probe"""
+        return self.state != "closed" or self.remaining(now) > 0
+
+    def success(self):
+        with self.lock:
+            if self.state != "closed":
+                print("✓ Server reachable again, circuit closed")
+            self.failures = 0
+            self.not_before = 0.0
+            self.state = "closed"
+        METRICS.set("agent_circuit_open", 0)
+
+    def failure(self, retry_after=None, now=None):
+        """Record a failed call; returns seconds until the next attempt"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.failures += 1
+            if self.state == "half-open" or self.failures >= self.threshold:
+                if self.state == "closed":
+                    print(f"⨯ Circuit open after {self.failures} failures, pausing server calls")
+                self.state = "open"
+                # Equal jitter: a guaranteed rest, with probes spread over the second half
+                wait = random.uniform(self.cooldown / 2, self.cooldown)
+            else:
+                wait = random.uniform(0, min(self.cap, self.base * 2 ** self.failures))
+            if retry_after is not None:
+                # Spread the fleet after the server's deadline rather than all at it
+                wait = max(wait, retry_after + random.uniform(0, self.base))
+            self.not_before = now + wait
+        METRICS.set("agent_circuit_open", int(self.state == "open"))
+        return wait
+
+BACKOFF = ServerBackoff()
+
+# -------- Payload Encoding --------
+DELTA_CONTENT_TYPE = "application/vnd.health-agent.delta+json"
+
+def payload_diff(old, new):
+    """Changed subtree and removed key paths between two payloads; lists are replaced whole"""
+    changed, removed = {}, []
+    for key, value in new.items():
+        if key not in old:
+            changed[key] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            sub, gone = payload_diff(old[key], value)
+            if sub:
+                changed[key] = sub
+            removed += [[key] + path for path in gone]
+        elif value != old[key] or type(value) is not type(old[key]):
+            changed[key] = value
+    removed += [[key] for key in old if key not in new]
+    return changed, removed
+
+def payload_apply(base, changed, removed=()):
+    """Inverse of payload_diff; returns a new payload and leaves base untouched"""
+    result = dict(base)
+    for key, value in changed.items():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = payload_apply(result[key], value)
+        else:
+            result[key] = value
+    for path in removed:
+        node = result
+        for key in path[:-1]:
+            node[key] = dict(node[key])
+            node = node[key]
+        node.pop(path[-1], None)
+    return result
+
+class DeltaEncoder:
+    """Keyframe every N uploads, and only the fields that changed in between"""
+
+    def __init__(self, keyframe_every=PAYLOAD_KEYFRAME_EVERY):
+        self.keyframe_every = keyframe_every
+        self.seq = 0
+        self.base = None  # Last payload the server acknowledged
+        self.pending = None
+        self.since_keyframe = 0
+
+    def encode(self, payload):
+        self.seq += 1
+        self.pending = payload
+        if self.base is None or self.since_keyframe >= self.keyframe_every:
+            self.since_keyframe = 1
+            return {"format": "delta/1", "seq": self.seq, "keyframe": True, "data": payload}
+        self.since_keyframe += 1
+        changed, removed = payload_diff(self.base, payload)
+        frame = {"format": "delta/1", "seq": self.seq, "base": self.seq - 1, "set": changed}
+        if removed:
+            frame["del"] = removed
+        return frame
+
+    def commit(self):
+        """The last frame was accepted; later deltas build on it"""
+        self.base = self.pending
+
+    def reset(self):
+        """The server may not have our base; the next frame is a keyframe"""
+        self.base = None
+
+class DeltaDecoder:
+    """Server-side reconstruction of full payloads from delta frames, one per device"""
+
+    def __init__(self):
+        self.seq = None
+        self.state = None
+
+    def decode(self, frame):
+        if frame.get("keyframe"):
+            self.state = frame["data"]
+        elif self.state is None or frame.get("base") != self.seq:
+            raise ValueError(f"Delta {frame.get('seq')} needs base {frame.get('base')}, have {self.seq}")
+        else:
+            self.state = payload_apply(self.state, frame["set"], frame.get("del", ()))
+        self.seq = frame["seq"]
+        return self.state
+
+ENCODER = DeltaEncoder() if PAYLOAD_FORMAT == "delta" else None
+
+# -------- Device Identity --------
+class DeviceIdentity:
+    """Device ID and key cached together on disk, so /api/device/me is asked once"""
+
+    def __init__(self, path, device_key):
+        self.path = path
+        self.lock = threading.Lock()
+        self.device_key = device_key
+        self.device_id = None
+        try:
+            cached = json.loads(self.path.read_text())
+            # A different key in .env means a different device
+            if cached.get("device_key") == device_key:
+                self.device_id = cached.get("device_id")
+        except (OSError, ValueError):
+            pass
+
+    def _save(self):
+        try:
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps({"device_id": self.device_id, "device_key": self.device_key}))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"⨯ Could not save device identity: {e}")
+
+    def get_id(self):
+        """Cached device ID, looked up from the server only when unknown"""
+        with self.lock:
+            if self.device_id is None:
+                r = TRANSPORT.get("/api/device/me")
+                if r.status_code != 200:
+                    raise Exception(f"Failed to get device ID: HTTP {r.status_code}")
+                self.device_id = r.json()["id"]
+                self._save()
+                print(f"✓ Connected as device #{self.device_id}")
+            return self.device_id
+
+    def set_key(self, device_key, device_id=None):
+        with self.lock:
+            self.device_key = device_key
+            self.device_id = device_id
+            TRANSPORT.set_device_key(device_key)
+            self._save()
+
+    def invalidate(self):
+        with self.lock:
+            self.device_id = None
+            try:
+                self.path.unlink()
+            except OSError:
+                pass
+
+    def check(self, response, not_found=True):
+        """Forget the cached ID when the server no longer knows this device"""
+        if response.status_code == 401 or (not_found and response.status_code == 404):
+            print(f"⨯ Server rejected device identity (HTTP {response.status_code})")
+            self.invalidate()
+        return response
+
+IDENTITY = DeviceIdentity(IDENTITY_PATH, DEVICE_KEY)
+
+# -------- Metrics Spool --------
+class MetricsSpool:
+    """Bounded, crash-safe SQLite queue of samples waiting to be uploaded"""
+
+    def __init__(self, path, max_samples=SPOOL_MAX_SAMPLES, max_mb=SPOOL_MAX_MB, max_age=SPOOL_MAX_AGE):
+        self.max_samples = max_samples
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        """Opened on first use; --task runs never create the spool file"""
+        if self._db is None:
+            import sqlite3
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS spool ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL NOT NULL, payload TEXT NOT NULL)"
+            )
+            self._db = db
+        return self._db
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def push(self, payload):
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO spool (created, payload) VALUES (?, ?)",
+                (time.time(), json.dumps(payload, separators=(",", ":"))),
+            )
+            self._evict()
+
+    def _evict(self):
+        """Drop the oldest samples once age, count or size limits are hit"""
+        self.db.execute("DELETE FROM spool WHERE created < ?", (time.time() - self.max_age,))
+        self.db.execute(
+            "DELETE FROM spool WHERE id <= (SELECT id FROM spool ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (self.max_samples,),
+        )
+        page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+        while True:
+            used = self.db.execute("PRAGMA page_count").fetchone()[0] - self.db.execute("PRAGMA freelist_count").fetchone()[0]
+            if used * page_size <= self.max_bytes:
+                break
+            count = self.db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+            if count == 0:
+                break
+            # Free pages are reused by later inserts, so the file stays bounded
+            self.db.execute(
+                "DELETE FROM spool WHERE id IN (SELECT id FROM spool ORDER BY id LIMIT ?)",
+                (max(1, count // 10),),
+            )
+
+    def peek(self, limit):
+        """Oldest samples as (id, payload) pairs, without removing them"""
+        with self.lock:
+            rows = self.db.execute("SELECT id, payload FROM spool ORDER BY id LIMIT ?", (limit,)).fetchall()
+        return [(row_id, json.loads(payload)) for row_id, payload in rows]
+
+    def ack(self, last_id):
+        """Remove every sample up to and including last_id"""
+        with self.lock:
+            self.db.execute("DELETE FROM spool WHERE id <= ?", (last_id,))
+
+SPOOL = MetricsSpool(SPOOL_PATH)
+
+# -------- Metrics History --------
+HISTORY_TIERS = (("raw", 1), ("minute", 60), ("hour", 3600))  # Finest first
+HISTORY_SKIP = {"extra.collected_at", "extra.system.boot_time", "extra.sample_window_s", "extra.rollup_samples"}
+HISTORY_MAX_POINTS = 120  # Default bucket size keeps a query to about this many points
+# Tier columns as (count, sum, min, max), so one query shape serves raw samples and rollups
+HISTORY_COLUMNS = {"raw": ("1", "value", "value", "value")}
+
+def flatten_numbers(payload, prefix="", out=None):
+    """Numeric leaves of a payload keyed by dotted path; lists and strings are skipped"""
+    out = {} if out is None else out
+    for key, value in payload.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flatten_numbers(value, path + ".", out)
+        elif (isinstance(value, (int, float)) and not isinstance(value, bool)
+              and math.isfinite(value) and path not in HISTORY_SKIP):
+            out[path] = value
+    return out
+
+class MetricsHistory:
+    """Local SQLite time series of every sample: raw, then 1-minute and 1-hour rollups
+
+    Each tier is a WITHOUT ROWID table clustered on (metric, ts), so a range
+    query for one metric reads contiguous pages.
+    """
+
+    def __init__(self, path, max_mb=HISTORY_MAX_MB, retention=HISTORY_RETENTION):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.ids = {}  # metric name -> id
+        self.next_prune = 0
+        self._db = None
+
+    @property
+    def db(self):
+        """Opened on first use, like the spool"""
+        if self._db is None:
+            import sqlite3
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS metrics (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS raw ("
+                "metric INTEGER, ts INTEGER, value REAL, PRIMARY KEY (metric, ts)) WITHOUT ROWID"
+            )
+            for table, _ in HISTORY_TIERS[1:]:
+                db.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} (metric INTEGER, ts INTEGER, "
+                    "n INTEGER, total REAL, low REAL, high REAL, PRIMARY KEY (metric, ts)) WITHOUT ROWID"
+                )
+            self.ids = dict(db.execute("SELECT name, id FROM metrics"))
+            self._db = db
+        return self._db
+
+    def _metric_ids(self, names):
+        missing = [(name,) for name in names if name not in self.ids]
+        if missing:
+            self.db.executemany("INSERT OR IGNORE INTO metrics (name) VALUES (?)", missing)
+            self.ids = dict(self.db.execute("SELECT name, id FROM metrics"))
+        return self.ids
+
+    def record(self, payload, ts=None):
+        """Store one sample in every tier; pruning runs at most every five minutes"""
+        ts = int(ts or payload.get("extra", {}).get("collected_at") or time.time())
+        values = flatten_numbers(payload)
+        with self.lock:
+            ids = self._metric_ids(values)
+            rows = [(ids[name], ts, value) for name, value in values.items()]
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany("INSERT OR REPLACE INTO raw VALUES (?, ?, ?)", rows)
+                for table, step in HISTORY_TIERS[1:]:
+                    bucket = ts - ts % step
+                    self.db.executemany(
+                        f"INSERT INTO {table} VALUES (?, ?, 1, ?, ?, ?) ON CONFLICT (metric, ts) DO UPDATE SET "
+                        "n = n + 1, total = total + excluded.total, "
+                        "low = min(low, excluded.low), high = max(high, excluded.high)",
+                        [(metric, bucket, value, value, value) for metric, _, value in rows],
+                    )
+                if ts >= self.next_prune:
+                    self.next_prune = ts + 300
+                    self._prune(ts)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _prune(self, now):
+        """Apply tier retention, then drop the oldest rollups while over the size limit
+
+        Minutes go first: they are most of the file, and the hour tier still
+        covers the time they spanned.
+        """
+        for table, _ in HISTORY_TIERS:
+            # Per-metric range deletes on the primary key instead of a full table scan
+            self.db.execute(
+                f"DELETE FROM {table} WHERE metric IN (SELECT id FROM metrics) AND ts < ?",
+                (now - self.retention[table],),
+            )
+        page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+        for table, step in HISTORY_TIERS[1:]:
+            while True:
+                used = self.db.execute("PRAGMA page_count").fetchone()[0] - self.db.execute("PRAGMA freelist_count").fetchone()[0]
+                if used * page_size <= self.max_bytes:
+                    return
+                oldest, newest = self.db.execute(f"SELECT MIN(ts), MAX(ts) FROM {table}").fetchone()
+                if oldest is None:
+                    break
+                # Free pages are reused by later inserts, so the file stays bounded
+                cut = oldest + max(step, (newest - oldest) // 10)
+                self.db.execute(f"DELETE FROM {table} WHERE ts < ?", (cut,))
+
+    def metrics(self):
+        """Every metric name ever recorded"""
+        with self.lock:
+            return sorted(name for (name,) in self.db.execute("SELECT name FROM metrics"))
+
+    def query(self, pattern, start, end, step=None, now=None):
+        """Bucketed count/avg/min/max for metrics matching a glob
+
+        Reads the coarsest tier that still covers start and divides the
+        bucket size, so a week-long query scans hours rather than minutes.
+        """
+        now = time.time() if now is None else now
+        covering = [tier for tier in HISTORY_TIERS if start >= now - self.retention[tier[0]]] or HISTORY_TIERS[-1:]
+        wanted = step or (end - start) / HISTORY_MAX_POINTS
+        table, resolution = next(
+            (tier for tier in reversed(covering) if (step and step % tier[1] == 0) or (not step and tier[1] <= wanted)),
+            covering[0],
+        )
+        step = max(resolution, math.ceil(wanted / resolution) * resolution)
+        n, total, low, high = HISTORY_COLUMNS.get(table, ("n", "total", "low", "high"))
+        with self.lock:
+            db = self.db  # Loads the metric names
+            names = {metric: name for name, metric in self.ids.items() if fnmatch.fnmatchcase(name, pattern)}
+            rows = db.execute(
+                f"SELECT metric, ts / ? * ?, SUM({n}), SUM({total}), MIN({low}), MAX({high}) FROM {table} "
+                f"WHERE metric IN ({','.join('?' * len(names))}) AND ts >= ? AND ts < ? "
+                "GROUP BY metric, 2 ORDER BY metric, 2",
+                (step, step, *names, int(start), math.ceil(end)),
+            ).fetchall()
+        result = {name: {"tier": table, "step": step, "points": []} for name in names.values()}
+        for metric, bucket, count, total, low, high in rows:
+            result[names[metric]]["points"].append((bucket, count, total / count, low, high))
+        for series in result.values():
+            points = series["points"]
+            count = sum(point[1] for point in points)
+            series["summary"] = {
+                "count": count,
+                "avg": sum(point[1] * point[2] for point in points) / count if count else None,
+                "min": min((point[3] for point in points), default=None),
+                "max": max((point[4] for point in points), default=None),
+            }
+        return dict(sorted(result.items()))
+
+HISTORY = MetricsHistory(HISTORY_PATH) if HISTORY_ENABLED else None
+
+def record_history(payload):
+    """Keep a local copy of the sample; history problems never stop uploads"""
+    if HISTORY is None:
+        return
+    try:
+        HISTORY.record(payload)
+    except Exception as e:
+        print(f"⨯ Could not record history: {e}")
+
+DURATION_RE = re.compile(r"^(\d+(?:\.\d+)?)([smhd])$")
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def parse_duration(text):
+    match = DURATION_RE.match(text.strip())
+    if not match:
+        raise ValueError(f"Invalid duration: {text!r} (expected e.g. 90s, 20m, 6h, 7d)")
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+def parse_when(text, now):
+    """'now', a duration back from now or an ISO date/time, as a Unix timestamp"""
+    if text == "now":
+        return now
+    if DURATION_RE.match(text.strip()):
+        return now - parse_duration(text)
+    return datetime.fromisoformat(text).timestamp()
+
+def query_history(pattern, since="1h", until="now", step=None, as_json=False):
+    """--query: print local history for metrics matching a glob"""
+    if HISTORY is None or not Path(HISTORY.path).exists():
+        print("⨯ No local history (HISTORY_ENABLED=0, or nothing recorded yet)")
+        return 1
+    if not pattern:
+        print("\n".join(HISTORY.metrics()))
+        return 0
+    now = time.time()
+    try:
+        start, end = parse_when(since, now), parse_when(until, now)
+        step = parse_duration(step) if step else None
+    except ValueError as e:
+        print(f"⨯ {e}")
+        return 1
+    result = HISTORY.query(pattern, start, end, step, now=now)
+    if not result:
+        print(f"⨯ No metric matches {pattern!r}; run --query without a metric to list them")
+        return 1
+    if as_json:
+        print(json.dumps(result))
+        return 0
+    for name, series in result.items():
+        print(f"{name}  ({series['tier']} tier, {series['step']}s buckets)")
+        for bucket, count, avg, low, high in series["points"]:
+            when = datetime.fromtimestamp(bucket).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"  {when}  avg {avg:10.2f}  min {low:10.2f}  max {high:10.2f}  n {count}")
+        summary = series["summary"]
+        if summary["count"]:
+            print(f"  overall  avg {summary['avg']:.2f}  min {summary['min']:.2f}  "
+                  f"max {summary['max']:.2f}  n {summary['count']}")
+        else:
+            print("  no samples in range")
+    return 0
+
+def run(cmd, timeout=None):
+    """Output of a shell command; inside a task it is killed at the task's deadline"""
+    if timeout is None:
+        deadline = getattr(_task_context, "deadline", None)
+        timeout = max(deadline - time.monotonic(), 0.1) if deadline else None
+    try:
+        out = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT, text=True, timeout=timeout)
+        return out.strip()
+    except subprocess.CalledProcessError as e:
+        return e.output.strip()
+    except subprocess.TimeoutExpired as e:
+        output = e.output.decode(errors="replace") if isinstance(e.output, bytes) else (e.output or "")
+        return f"{output.strip()}\nTimed out after {timeout:.0f}s".strip()
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+# -------- GPU Telemetry --------
+class GpuMonitor:
+    """All NVIDIA GPUs from one long-lived nvidia-smi stream, parsed on a background thread"""
+
+    FIELDS = ("index", "name", "utilization.gpu", "temperature.gpu",
+              "memory.used", "memory.total", "power.draw")
+    KEYS = ("index", "name", "util", "temp", "memory_used_mb", "memory_total_mb", "power_w")
+    RETRY_BASE = 30  # Seconds before asking a failing nvidia-smi again, doubling per failure
+    RETRY_MAX = 3600
+
+    def __init__(self, period_ms=GPU_SAMPLE_MS):
+        self.period_ms = period_ms
+        self.lock = threading.Lock()
+        self.gpus = {}  # index -> latest reading
+        self.available = None  # Decided once: is nvidia-smi on PATH?
+        self.failures = 0  # Consecutive queries or streams that gave no usable reading
+        self.retry_at = 0.0
+        self.proc = None
+        self.thread = None
+        self.streaming = False
+
+    def _command(self, stream):
+        cmd = [self.exe, f"--query-gpu={','.join(self.FIELDS)}", "--format=csv,noheader,nounits"]
+        if stream:
+            cmd += ["-lms", str(self.period_ms)]
+        return cmd
+
+    def _detect(self):
+        if self.available is None:
+            self.exe = shutil.which("nvidia-smi")
+            self.available = self.exe is not None
+        return self.available
+
+    def _ready(self):
+        """nvidia-smi exists and is not backing off after failures"""
+        return self._detect() and time.monotonic() >= self.retry_at
+
+    def _failed(self):
+        """No usable reading (driver reset, transient error); back off instead of giving up for good"""
+        self.failures += 1
+        self.retry_at = time.monotonic() + min(self.RETRY_BASE * 2 ** (self.failures - 1), self.RETRY_MAX)
+
+    def _parse(self, line):
+        parts = [p.strip() for p in line.split(",")]
+        if len(parts) != len(self.FIELDS) or not parts[0].isdigit():
+            return None
+        gpu = {}
+        for key, value in zip(self.KEYS, parts):
+            if key == "name":
+                gpu[key] = value
+            else:
+                try:
+                    gpu[key] = int(value) if key == "index" else float(value)
+                except ValueError:
+                    gpu[key] = None  # [N/A] or [Not Supported]
+        return gpu
+
+    def read_once(self):
+        """Single synchronous query, used before the stream has produced data"""
+        if not self._ready():
+            return []
+        try:
+            out = subprocess.run(self._command(stream=False), capture_output=True, text=True, timeout=5,
+                                 creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0)).stdout
+        except (OSError, subprocess.SubprocessError):
+            out = ""
+        gpus = [gpu for gpu in map(self._parse, out.splitlines()) if gpu]
+        if gpus:
+            self.failures = 0
+        else:
+            self._failed()
+        return gpus
+
+    def start(self):
+        if self.thread or not self._detect():
+            return
+        self.streaming = True
+        if not self._ready():
+            return  # snapshot() starts it once the backoff is over
+        try:
+            self.proc = subprocess.Popen(self._command(stream=True), stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL, text=True, bufsize=1,
+                                         creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+        except OSError:
+            self._failed()
+            return
+        self.thread = threading.Thread(target=self._reader, args=(self.proc,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.streaming = False
+        proc, self.proc = self.proc, None
+        if proc:
+            proc.terminate()
+            proc.wait()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _reader(self, proc):
+        got_data = False
+        for line in proc.stdout:
+            gpu = self._parse(line)
+            if gpu:
+                if not got_data:
+                    got_data = True
+                    self.failures = 0
+                with self.lock:
+                    self.gpus[gpu["index"]] = gpu
+        if not got_data and self.streaming:
+            self._failed()
+        if self.proc is proc:
+            # nvidia-smi went away (e.g. driver reset); snapshot() respawns it
+            self.proc = None
+            self.thread = None
+
+    def snapshot(self):
+        """Latest reading for every GPU, or [] on machines without one"""
+        if not self._ready():
+            return []  # No nvidia-smi, or backing off after failures
+        if self.streaming and self.thread is None:
+            self.start()
+        with self.lock:
+            gpus = [dict(gpu) for _, gpu in sorted(self.gpus.items())]
+        return gpus or self.read_once()
+
+GPU = GpuMonitor()
+
+def get_gpu_info(gpus=None):
+    """Name, utilisation and temperature of the first GPU"""
+    gpus = GPU.snapshot() if gpus is None else gpus
+    if gpus:
+        gpu = gpus[0]
+        return gpu["name"], gpu["util"] or 0.0, gpu["temp"] or 0.0
+    # Fallbacks
+    return "Unknown", 0.0, 0.0
+
+# -------- Linux /proc Backend --------
+CpuSplit = collections.namedtuple("CpuSplit", "total busy")  # Jiffies, guest time excluded
+Snapshot = collections.namedtuple("Snapshot", "time cpu net disk ram_percent")  # One sampler read
+NetIO = collections.namedtuple("NetIO", "bytes_sent bytes_recv")
+DiskIO = collections.namedtuple("DiskIO", "read_bytes write_bytes")
+
+class ProcFS:
+    """Reads the few /proc files a sample needs through kept-open descriptors and one buffer
+
+    Values match what psutil derives from the same files (busy CPU, memory
+    percent, net and disk I/O totals, per-process CPU and memory) without
+    psutil's per-call open/parse/namedtuple overhead.
+    """
+
+    FILES = ("stat", "meminfo", "net/dev", "diskstats")
+    SECTOR_BYTES = 512  # /proc/diskstats always counts 512-byte sectors
+    NET_RE = re.compile(rb":\s*(\d+)(?:\s+\d+){7}\s+(\d+)")
+    DISK_RE = re.compile(rb"^ *\d+ +\d+ (\S+) \d+ \d+ (\d+) \d+ \d+ \d+ (\d+)", re.M)
+
+    def __init__(self, root="/proc"):
+        self.root = root
+        self.fds = None
+        self.size = 64 * 1024  # Read size; doubled when a file outgrows it
+        self.ticks = os.sysconf("SC_CLK_TCK")
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.storage = {}  # diskstats name -> whole device (not a partition)?
+
+    def _open(self):
+        if self.fds is None:
+            self.fds = {name: os.open(f"{self.root}/{name}", os.O_RDONLY) for name in self.FILES}
+
+    def read(self, name, whole=True):
+        """Current contents of one file; with whole=False the first read is enough"""
+        self._open()
+        while True:
+            data = os.pread(self.fds[name], self.size, 0)
+            if len(data) < self.size or not whole:
+                return data
+            self.size *= 2
+
+    @staticmethod
+    def _cpu_split(line):
+        values = [*map(int, line.split()[1:11])]
+        # guest time is already counted in user/nice; idle includes iowait
+        all_time = sum(values) - sum(values[8:10])
+        return CpuSplit(all_time, all_time - values[3] - values[4])
+
+    def cpu(self):
+        """Aggregate CpuSplit from the first line of /proc/stat"""
+        # cpu lines come first, so the file's huge intr line never needs reading
+        data = self.read("stat", whole=False)
+        return self._cpu_split(data[:data.index(b"\n")])
+
+    def cpu_cores(self):
+        """Per-core CpuSplit from /proc/stat; only needed once per upload window"""
+        cores = []
+        for line in self.read("stat", whole=False).split(b"\n")[1:]:
+            if not line.startswith(b"cpu"):
+                break
+            cores.append(self._cpu_split(line))
+        return cores
+
+    def _meminfo(self, data, key):
+        start = data.find(key)
+        if start < 0:
+            return None
+        start += len(key)
+        return int(data[start:data.index(b"k", start)]) * 1024
+
+    def _available(self, data):
+        available = self._meminfo(data, b"MemAvailable:")
+        if available is None:  # Kernels before 3.14
+            available = sum(self._meminfo(data, k) or 0 for k in (b"MemFree:", b"\nBuffers:", b"\nCached:"))
+        return available
+
+    def memory_percent(self):
+        """virtual_memory().percent alone, for the per-tick sample"""
+        data = self.read("meminfo")
+        total = self._meminfo(data, b"MemTotal:")
+        return round((total - self._available(data)) / total * 100, 1) if total else 0.0
+
+    def memory(self):
+        """virtual_memory/swap_memory percentages and bytes from /proc/meminfo"""
+        data = self.read("meminfo")
+        total = self._meminfo(data, b"MemTotal:") or 0
+        available = self._available(data)
+        swap_total = self._meminfo(data, b"SwapTotal:") or 0
+        swap_used = swap_total - (self._meminfo(data, b"SwapFree:") or 0)
+        return {
+            "total": total,
+            "available": available,
+            "percent": round((total - available) / total * 100, 1) if total else 0.0,
+            "swap_percent": round(swap_used / swap_total * 100, 1) if swap_total else 0.0,
+        }
+
+    def net_io(self):
+        """Bytes sent/received summed over every interface, like psutil.net_io_counters()"""
+        sent = recv = 0
+        for rx, tx in self.NET_RE.findall(self.read("net/dev")):
+            recv += int(rx)
+            sent += int(tx)
+        return NetIO(sent, recv)
+
+    def _is_storage(self, name):
+        # Same rule as psutil: whole devices appear in /sys/block, partitions do not
+        if name not in self.storage:
+            self.storage[name] = os.path.exists("/sys/block/" + name.decode().replace("/", "!"))
+        return self.storage[name]
+
+    def disk_io(self):
+        """Bytes read/written summed over whole devices, like psutil.disk_io_counters()"""
+        read = written = 0
+        storage = self.storage
+        for name, sectors_read, sectors_written in self.DISK_RE.findall(self.read("diskstats")):
+            if storage.get(name) or (name not in storage and self._is_storage(name)):
+                read += int(sectors_read)
+                written += int(sectors_written)
+        return DiskIO(read * self.SECTOR_BYTES, written * self.SECTOR_BYTES)
+
+    def snapshot(self):
+        """Everything one sampler tick needs, one read per file"""
+        return Snapshot(time.monotonic(), self.cpu(), self.net_io(), self.disk_io(), self.memory_percent())
+
+    def processes(self):
+        """(pid, start ticks, comm, cpu ticks, rss bytes) for every process, one read each"""
+        for pid in os.listdir(self.root):
+            if not pid.isdigit():
+                continue
+            try:
+                fd = os.open(f"{self.root}/{pid}/stat", os.O_RDONLY)
+                try:
+                    data = os.read(fd, 4096)
+                finally:
+                    os.close(fd)
+            except OSError:
+                continue  # Exited while we looked
+            # "pid (comm) state ..."; comm may itself contain spaces and parentheses
+            head, _, rest = data.rpartition(b")")
+            fields = rest.split(None, 22)
+            yield (int(pid), int(fields[19]), head.partition(b"(")[2].decode("utf-8", "replace"),
+                   int(fields[11]) + int(fields[12]), int(fields[21]) * self.page_size)
+
+    def full_name(self, pid, comm):
+        """comm is cut at 15 characters; like psutil, prefer argv[0] when it extends it"""
+        if len(comm) < 15:
+            return comm
+        try:
+            with open(f"{self.root}/{pid}/cmdline", "rb") as f:
+                exe = os.path.basename(f.read().split(b"\0")[0].decode("utf-8", "replace"))
+        except OSError:
+            return comm
+        return exe if exe.startswith(comm) else comm
+
+# Chosen once: /proc on Linux, psutil everywhere else (or when disabled)
+PROCFS = ProcFS() if PROCFS_BACKEND and sys.platform.startswith("linux") and os.path.exists("/proc/stat") else None
+
+# -------- Counter Sampling --------
+def _cpu_busy_percent(t1, t2):
+    """Busy CPU percentage between two cpu_times() (or ProcFS CpuSplit) snapshots"""
+    def split(t):
+        if isinstance(t, CpuSplit):
+            return t
+        total = sum(t)
+        # guest time is already counted in user/nice on Linux
+        total -= getattr(t, "guest", 0) + getattr(t, "guest_nice", 0)
+        idle = t.idle + getattr(t, "iowait", 0)
+        return total, total - idle
+    total1, busy1 = split(t1)
+    total2, busy2 = split(t2)
+    if total2 <= total1:
+        return 0.0
+    busy = (busy2 - busy1) / (total2 - total1) * 100
+    return max(0.0, min(100.0, busy))
+
+class RingBuffer:
+    """Fixed-size ring of floats backed by array('d'), no per-sample objects"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = array.array("d", bytes(8 * capacity))
+        self.count = 0  # Total values ever written; doubles as a position marker
+
+    def append(self, value):
+        self.data[self.count % self.capacity] = value
+        self.count += 1
+
+    def since(self, mark):
+        """Values written after a position returned by an earlier `count`"""
+        n = min(self.count - mark, self.capacity)
+        if n <= 0:
+            return array.array("d")
+        end = self.count % self.capacity
+        start = (end - n) % self.capacity
+        if start < end:
+            return self.data[start:end]
+        return self.data[start:] + self.data[:end]
+
+    def rollup(self, mark):
+        values = self.since(mark)
+        if not values:
+            return None
+        ordered = sorted(values)
+        return {
+            "min": round(ordered[0], 2),
+            "max": round(ordered[-1], 2),
+            "mean": round(math.fsum(values) / len(values), 2),
+            "p95": round(percentile(ordered, 95), 2),
+        }
+
+class CounterSampler:
+    """Samples counters every SAMPLE_PERIOD into ring buffers; rolls them up per upload window"""
+
+    METRICS = ("cpu_percent", "ram_percent", "gpu_util",
+               "net_up_mbps", "net_down_mbps", "disk_read_mbps", "disk_write_mbps")
+
+    def __init__(self, period=SAMPLE_PERIOD, capacity=SAMPLE_BUFFER):
+        self.period = period
+        self.lock = threading.Lock()
+        self.stop_flag = threading.Event()
+        self.thread = None
+        self.rings = {name: RingBuffer(capacity) for name in self.METRICS}
+        self.latest = dict.fromkeys(self.METRICS, 0.0)  # Last tick's rates, overwritten in place each tick
+        self.prev = None  # First snapshot is taken on start() or the first tick
+        # Start of the current upload window
+        self.window_snap = None
+        self.window_cores = None  # Per-core times are read at window edges only, not every tick
+        self.window_mark = 0
+
+    def _prime(self):
+        if self.prev is None:
+            self.prev = self.window_snap = self._snapshot()
+            self.window_cores = self._cores()
+
+    def prime(self):
+        """Take the first snapshot now, so the first window has a real duration"""
+        with self.lock:
+            self._prime()
+
+    def _snapshot(self):
+        if PROCFS:
+            return PROCFS.snapshot()
+        try:
+            disk = psutil.disk_io_counters()
+        except Exception:
+            disk = None
+        return Snapshot(time.monotonic(), psutil.cpu_times(), psutil.net_io_counters(), disk,
+                        psutil.virtual_memory().percent)
+
+    @staticmethod
+    def _cores():
+        return PROCFS.cpu_cores() if PROCFS else psutil.cpu_times(percpu=True)
+
+    @staticmethod
+    def _rates(prev, cur, out):
+        """Fill out with the rates between two snapshots; returns out"""
+        elapsed = max(cur.time - prev.time, 1e-6)
+        out["window_s"] = elapsed
+        out["cpu_percent"] = _cpu_busy_percent(prev.cpu, cur.cpu)
+        # Counters can go backwards when an interface resets
+        out["net_up_mbps"] = max((cur.net.bytes_sent - prev.net.bytes_sent) * 8 / 1_000_000 / elapsed, 0.0)
+        out["net_down_mbps"] = max((cur.net.bytes_recv - prev.net.bytes_recv) * 8 / 1_000_000 / elapsed, 0.0)
+        if cur.disk and prev.disk:
+            out["disk_read_mbps"] = max((cur.disk.read_bytes - prev.disk.read_bytes) / (1024**2) / elapsed, 0.0)
+            out["disk_write_mbps"] = max((cur.disk.write_bytes - prev.disk.write_bytes) / (1024**2) / elapsed, 0.0)
+        else:
+            out["disk_read_mbps"] = out["disk_write_mbps"] = 0.0
+        return out
+
+    def tick(self):
+        """Take a snapshot and write the rates since the previous one into latest and the rings
+
+        Returns latest, which the next tick overwrites; copy it to keep it.
+        """
+        with self.lock:
+            self._prime()
+            cur = self._snapshot()
+            latest = self._rates(self.prev, cur, self.latest)
+            self.prev = cur
+            latest["ram_percent"] = cur.ram_percent
+            if GPU.gpus:
+                with GPU.lock:  # Latest streamed reading, never spawns nvidia-smi
+                    latest["gpu_util"] = max((g["util"] or 0.0 for g in GPU.gpus.values()), default=0.0)
+            else:
+                latest["gpu_util"] = 0.0
+            for name, ring in self.rings.items():
+                ring.append(latest[name])
+        return latest
+
+    def window(self, series=False):
+        """Rates and rollups since the previous call, then start a new window
+
+        With series, the window's raw samples are included as well.
+        """
+        self.tick()
+        with self.lock:
+            start, cur = self.window_snap, self.prev
+            rates = self._rates(start, cur, {})
+            cores = self._cores()
+            rates["per_core"] = [
+                round(_cpu_busy_percent(a, b), 1)
+                for a, b in zip(self.window_cores, cores)
+            ]
+            # 1/5/15 minute load; os.getloadavg reads /proc/loadavg on Linux
+            rates["load_avg"] = [round(v, 2) for v in os.getloadavg()] if hasattr(os, "getloadavg") else None
+            rates["samples"] = self.rings["cpu_percent"].count - self.window_mark
+            rates["rollups"] = {name: ring.rollup(self.window_mark) for name, ring in self.rings.items()}
+            if series:
+                rates["series"] = {name: [round(v, 2) for v in ring.since(self.window_mark)]
+                                   for name, ring in self.rings.items()}
+            self.window_snap = cur
+            self.window_cores = cores
+            self.window_mark = self.rings["cpu_percent"].count
+            return rates
+
+    def start(self):
+        if self.thread:
+            return
+        with self.lock:
+            self._prime()
+        self.stop_flag.clear()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_flag.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _loop(self):
+        while not self.stop_flag.wait(self.period):
+            try:
+                CADENCE.observe(self.tick())
+            except Exception as e:
+                print(f"Sampler error: {e}")
+
+SAMPLER = CounterSampler()
+
+# -------- Process Tracking --------
+class ProcessTracker:
+    """Persistent process table so per-process CPU is a real delta between cycles"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.procs = {}  # (pid, create_time) -> psutil.Process
+        self.cpu = {}  # (pid, start ticks) -> (cpu ticks, monotonic time), /proc backend
+        self.names = {}  # (pid, start ticks) -> full name, resolved once per process
+        self.keys = {}  # pid -> (pid, create_time)
+        self.rows = []
+        self.primed = False
+
+    def prime(self):
+        """Record CPU counters now, so the next refresh has a window to measure over"""
+        with self.lock:
+            if not self.primed:
+                self.primed = True
+                self._scan()
+
+    def refresh(self):
+        """Sync with running PIDs, dropping exited ones; returns fresh rows"""
+        with self.lock:
+            # The first scan primes CPU counters; rates come from the next one
+            self.primed = True
+            return self._scan()
+
+    def _scan(self):
+        return self._scan_procfs() if PROCFS else self._scan_psutil()
+
+    def _scan_procfs(self):
+        """One /proc/<pid>/stat read per process instead of several psutil calls"""
+        now = time.monotonic()
+        total = PROCFS.memory()["total"] or 1
+        rows, keys, cpu, names, samples = [], {}, {}, {}, []
+        for pid, started, comm, ticks, rss in PROCFS.processes():
+            key = (pid, started)
+            name = names[key] = self.names.get(key) or PROCFS.full_name(pid, comm)
+            prev = self.cpu.get(key)
+            percent = 0.0  # 0.0 only on a process's first cycle, as with psutil
+            if prev and now > prev[1]:
+                # Same as psutil's cpu_percent(None): share of one CPU since the last cycle
+                percent = (ticks - prev[0]) / PROCFS.ticks / (now - prev[1]) * 100
+            cpu[key] = (ticks, now)
+            keys[pid] = key
+            samples.append((key, name, rss))
+            rows.append({
+                "name": name,
+                "cpu_percent": round(percent, 1),
+                "memory_percent": round(rss / total * 100, 2),
+            })
+        self.cpu = cpu
+        self.names = names
+        self.keys = keys
+        self.rows = rows
+        MEMORY_HISTORY.record(now, samples)
+        return rows
+
+    def _scan_psutil(self):
+        now = time.monotonic()
+        total = psutil.virtual_memory().total or 1
+        rows, keys, samples = [], {}, []
+        for pid in psutil.pids():
+            key = self.keys.get(pid)
+            proc = self.procs.get(key) if key else None
+            try:
+                if proc is not None and not proc.is_running():
+                    # Exited or PID reused: the new process must not inherit the old CPU baseline or history
+                    self.procs.pop(key, None)
+                    proc = None
+                if proc is None:
+                    proc = psutil.Process(pid)
+                    key = (pid, proc.create_time())
+                    self.procs[key] = proc
+                with proc.oneshot():
+                    rss = proc.memory_info().rss
+                    row = {
+                        "name": proc.name(),
+                        "cpu_percent": proc.cpu_percent(None),  # 0.0 only on a process's first cycle
+                        "memory_percent": round(rss / total * 100, 2),
+                    }
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                if key:
+                    self.procs.pop(key, None)
+                continue
+            keys[pid] = key
+            samples.append((key, row["name"], rss))
+            rows.append(row)
+        # Forget processes that have exited since the last cycle
+        for key in set(self.keys.values()) - set(keys.values()):
+            self.procs.pop(key, None)
+        self.keys = keys
+        self.rows = rows
+        MEMORY_HISTORY.record(now, samples)
+        return rows
+
+    def __len__(self):
+        return len(self.keys)
+
+    def top(self, n, by="cpu_percent", rows=None):
+        """Top n rows by a field, using a heap instead of sorting everything"""
+        return heapq.nlargest(n, self.rows if rows is None else rows, key=lambda row: row[by])
+
+PROCESSES = ProcessTracker()
+
+# -------- Memory History --------
+class MemorySeries:
+    """RSS of one process over its lifetime in a fixed number of points"""
+
+    __slots__ = ("name", "start", "t", "mb", "stride", "acc_t", "acc_mb", "acc_n", "last")
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.t = array.array("f")  # seconds since start; float32 keeps a point at 8 bytes
+        self.mb = array.array("f")
+        self.stride = 1  # raw samples averaged into each new point
+        self.acc_t = self.acc_mb = 0.0
+        self.acc_n = 0
+        self.last = 0.0
+
+    def add(self, t, mb, points=MEMORY_HISTORY_POINTS):
+        self.last = mb
+        self.acc_t += t - self.start
+        self.acc_mb += mb
+        self.acc_n += 1
+        if self.acc_n < self.stride:
+            return
+        self.t.append(self.acc_t / self.acc_n)
+        self.mb.append(self.acc_mb / self.acc_n)
+        self.acc_t = self.acc_mb = 0.0
+        self.acc_n = 0
+        if len(self.t) >= points:
+            # Full: halve the resolution so the series still covers the whole lifetime
+            self.t = array.array("f", (
+                (self.t[i] + self.t[i + 1]) / 2 for i in range(0, len(self.t) - 1, 2)))
+            self.mb = array.array("f", (
+                (self.mb[i] + self.mb[i + 1]) / 2 for i in range(0, len(self.mb) - 1, 2)))
+            self.stride *= 2
+
+    def trend(self):
+        """Least-squares slope in MB/hour, r² and hours covered; None if too short"""
+        n = len(self.t)
+        if n < 4:
+            return None
+        mean_t = sum(self.t) / n
+        mean_mb = sum(self.mb) / n
+        sxx = sxy = syy = 0.0
+        for t, mb in zip(self.t, self.mb):
+            dt, dmb = t - mean_t, mb - mean_mb
+            sxx += dt * dt
+            sxy += dt * dmb
+            syy += dmb * dmb
+        if not sxx:
+            return None
+        r2 = sxy * sxy / (sxx * syy) if syy else 0.0
+        return sxy / sxx * 3600, r2, (self.t[-1] - self.t[0]) / 3600
+
+class MemoryHistory:
+    """Memory history of the largest processes, fed by the process tracker's scans"""
+
+    def __init__(self, limit=MEMORY_TRACK_MAX, min_mb=MEMORY_TRACK_MIN_MB, points=MEMORY_HISTORY_POINTS):
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.min_mb = min_mb
+        self.points = points
+        self.series = {}  # (pid, start time) -> MemorySeries
+
+    def record(self, now, samples):
+        """Add one scan of (key, name, rss bytes); exited processes are dropped"""
+        live, candidates = {}, []
+        with self.lock:
+            for key, name, rss in samples:
+                mb = rss / 1024**2
+                series = self.series.get(key)
+                if series is not None:
+                    series.add(now, mb, self.points)
+                    live[key] = series
+                elif mb >= self.min_mb:
+                    candidates.append((mb, key, name))
+            if len(live) + len(candidates) > self.limit:
+                # Keep the largest processes; a tracked one only loses its slot
+                # to one 25% bigger, so near-equal processes don't swap every scan
+                ranked = [(series.last * 1.25, key, None) for key, series in live.items()]
+                keep = heapq.nlargest(self.limit, ranked + candidates)
+                live = {key: live[key] for _, key, name in keep if name is None}
+                candidates = [entry for entry in keep if entry[2] is not None]
+            for mb, key, name in candidates:
+                series = live[key] = MemorySeries(name, now)
+                series.add(now, mb, self.points)
+            self.series = live
+
+    def suspects(self, limit=TOP_PROCESSES):
+        """Processes whose memory has grown steadily, fastest first"""
+        found = []
+        with self.lock:
+            for (pid, _), series in self.series.items():
+                trend = series.trend()
+                if not trend:
+                    continue
+                slope, r2, hours = trend
+                if slope >= LEAK_MIN_MB_PER_HOUR and r2 >= LEAK_MIN_R2 and hours >= LEAK_MIN_HOURS:
+                    found.append({
+                        "pid": pid,
+                        "name": series.name,
+                        "rss_mb": round(series.last, 1),
+                        "growth_mb_per_hour": round(slope, 1),
+                        "tracked_hours": round(hours, 2),
+                        "r2": round(r2, 2),
+                    })
+        return heapq.nlargest(limit, found, key=lambda row: row["growth_mb_per_hour"])
+
+    def __len__(self):
+        return len(self.series)
+
+MEMORY_HISTORY = MemoryHistory()
+
+def get_net_speeds_mbps():
+    """Measure link bandwidth with speedtest-cli (slow, saturates the link)"""
+    import speedtest
+    s = speedtest.Speedtest()
+    s.get_best_server()
+    down = s.download() / 1_000_000  # Convert to Mbps
+    up = s.upload() / 1_000_000  # Convert to Mbps
+    return round(up, 2), round(down, 2)
+
+class BandwidthProbe:
+    """Runs the speedtest on its own schedule and caches the result with a TTL"""
+
+    def __init__(self, interval, ttl):
+        self.interval = interval
+        self.ttl = ttl
+        self.lock = threading.Lock()  # Never run two speedtests at once
+        self.result = None
+        self.stop_flag = threading.Event()
+        self.wake = threading.Event()
+        self.wanted = False  # start() was called; a policy may enable probing later
+        self.thread = None
+
+    def run(self):
+        """Probe now (e.g. for network_diagnosis) and refresh the cache"""
+        with self.lock:
+            up, down = get_net_speeds_mbps()
+            self.result = {
+                "up_mbps": up,
+                "down_mbps": down,
+                "measured_at": time.time(),
+                "ttl_s": self.ttl,
+            }
+            return self.result
+
+    def cached(self):
+        """Last probe result, or None once it is older than the TTL"""
+        result = self.result
+        if result and time.time() - result["measured_at"] < self.ttl:
+            return result
+        return None
+
+    def start(self):
+        self.wanted = True
+        if self.thread or self.interval <= 0:
+            return
+        self.stop_flag.clear()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_flag.set()
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def set_interval(self, interval):
+        """Reschedule a running probe; 0 stops it"""
+        self.interval = interval
+        if interval <= 0:
+            self.stop()
+        elif self.wanted:
+            self.start()
+            self.wake.set()
+
+    def _loop(self):
+        # First probe at a random point in the interval, so agents restarted together don't all run one
+        last_run = time.monotonic() - random.uniform(0, self.interval)
+        while not self.stop_flag.is_set():
+            if time.monotonic() - last_run >= self.interval:
+                try:
+                    self.run()
+                except Exception as e:
+                    print(f"Bandwidth probe failed: {e}")
+                last_run = time.monotonic()
+            # Woken early when the interval changes
+            self.wake.wait(max(0.0, last_run + self.interval - time.monotonic()))
+            self.wake.clear()
+
+BANDWIDTH = BandwidthProbe(BANDWIDTH_PROBE_INTERVAL, BANDWIDTH_PROBE_TTL)
+
+# -------- Collectors --------
+class Collector:
+    """One part of collect_metrics, refreshed on its own interval and cached in between"""
+
+    def __init__(self, name, fn, interval, budget_ms):
+        self.name = name
+        self.fn = fn
+        self.interval = interval  # 0 runs every cycle, None only once at start-up
+        self.budget_ms = budget_ms
+        self.enabled = True
+        self.value = None
+        self.last_run = None
+        self.last_ms = 0.0
+
+    def due(self, now):
+        if self.last_run is None:
+            return True
+        if self.interval is None:
+            return False
+        return now - self.last_run >= self.interval
+
+    def get(self, now):
+        if not self.enabled:
+            return None
+        if self.due(now):
+            start = time.perf_counter()
+            try:
+                self.value = self.fn()
+            except Exception as e:
+                print(f"Collector {self.name} failed: {e}")  # Keep the previous value
+            self.last_ms = (time.perf_counter() - start) * 1000
+            self.last_run = now
+            METRICS.observe("agent_collector_seconds", self.last_ms / 1000, collector=self.name)
+            if self.last_ms > self.budget_ms:
+                print(f"ℹ️ Collector {self.name} took {self.last_ms:.0f}ms (budget {self.budget_ms}ms)")
+        return self.value
+
+COLLECTORS = {}
+
+def collector(name, interval, budget_ms=20):
+    """Register a collector; COLLECTOR_INTERVALS in .env can override the interval"""
+    def register(fn):
+        COLLECTORS[name] = Collector(name, fn, COLLECTOR_INTERVALS.get(name, interval), budget_ms)
+        return fn
+    return register
+
+def main_disk_path():
+    return "C:\\" if win() else "/"
+
+@collector("rates", interval=0)
+def collect_rates():
+    # CPU, per-core, network and disk I/O over the whole upload window;
+    # every sample of it while a spike is being watched
+    return SAMPLER.window(series=CADENCE.mode == "burst")
+
+@collector("memory", interval=0, budget_ms=5)
+def collect_memory():
+    if PROCFS:
+        mem = PROCFS.memory()
+        return {
+            "ram_percent": mem["percent"],
+            "available_gb": mem["available"] / (1024**3),
+            "swap_used_percent": mem["swap_percent"],
+        }
+    vm = psutil.virtual_memory()
+    swap = psutil.swap_memory()
+    return {
+        "ram_percent": vm.percent,
+        "available_gb": vm.available / (1024**3),
+        "swap_used_percent": swap.percent,
+    }
+
+@collector("gpu", interval=0, budget_ms=5)
+def collect_gpu():
+    return GPU.snapshot()
+
+@collector("cpu_freq", interval=15, budget_ms=5)
+def collect_cpu_freq():
+    freq = psutil.cpu_freq()
+    return freq.current if freq else 0
+
+@collector("processes", interval=15, budget_ms=250)
+def collect_processes():
+    # Enhanced process metrics from the persistent process table
+    rows = PROCESSES.refresh()
+    return {
+        "num_processes": len(PROCESSES),
+        "top_processes": PROCESSES.top(POLICY.get("top_processes"), "cpu_percent", rows),
+        "top_memory_processes": PROCESSES.top(POLICY.get("top_processes"), "memory_percent", rows),
+        "leak_suspects": MEMORY_HISTORY.suspects(POLICY.get("top_processes")),
+    }
+
+@collector("partitions", interval=600, budget_ms=50)
+def collect_partitions():
+    # Mounted drives and their sizes rarely change
+    partitions = {}
+    for part in psutil.disk_partitions(all=False):
+        if part.fstype:  # Skip empty drives
+            try:
+                partitions[part.mountpoint] = psutil.disk_usage(part.mountpoint).total / (1024**3)
+            except Exception:
+                continue
+    return partitions
+
+@collector("disk_usage", interval=60, budget_ms=50)
+def collect_disk_usage():
+    partitions = COLLECTORS["partitions"].get(time.monotonic()) or {}
+    usage = {}
+    for mountpoint in set(partitions) | {main_disk_path()}:
+        try:
+            usage[mountpoint] = psutil.disk_usage(mountpoint).percent
+        except Exception:
+            continue
+    return usage
+
+@collector("system", interval=None, budget_ms=50)
+def collect_system():
+    # Static facts, collected once at start-up
+    freq = psutil.cpu_freq()
+    return {
+        "os": "windows" if win() else "linux",
+        "boot_time": psutil.boot_time(),
+        "max_frequency_mhz": freq.max if freq else 0,
+        "memory_total_gb": psutil.virtual_memory().total / (1024**3),
+    }
+
+@METRICS.timed("agent_collect_seconds")
+def collect_metrics():
+    now = time.monotonic()
+
+    def get(name, default):
+        value = COLLECTORS[name].get(now)
+        return default if value is None else value
+
+    rates = get("rates", {})  # Empty when the sampler failed; the rest of the sample still goes up
+    memory = get("memory", {})
+    gpus = get("gpu", [])
+    gpu_name, gpu_util, gpu_temp = get_gpu_info(gpus)
+    processes = get("processes", {})
+    partitions = get("partitions", {})
+    usage = get("disk_usage", {})
+    system = get("system", {})
+
+    extra = {
+        "num_processes": processes.get("num_processes", 0),
+        "top_processes": processes.get("top_processes", []),
+        "top_memory_processes": processes.get("top_memory_processes", []),
+        "leak_suspects": processes.get("leak_suspects", []),
+        "gpus": gpus,
+        "cpu_info": {
+            "per_core": rates.get("per_core", []),
+            "load_avg": rates.get("load_avg", []),
+            "frequency_mhz": get("cpu_freq", 0),
+            "max_frequency_mhz": system.get("max_frequency_mhz", 0)
+        },
+        "memory_info": {
+            "total_gb": system.get("memory_total_gb", 0),
+            "available_gb": memory.get("available_gb", 0),
+            "swap_used_percent": memory.get("swap_used_percent", 0)
+        },
+        "disk_info": {
+            mountpoint: {"total_gb": total_gb, "used_percent": usage.get(mountpoint, 0)}
+            for mountpoint, total_gb in partitions.items()
+        },
+        "disk_io": {
+            "read_mbps": round(rates.get("disk_read_mbps", 0), 2),
+            "write_mbps": round(rates.get("disk_write_mbps", 0), 2)
+        },
+        "sample_window_s": round(rates.get("window_s", 0), 2),
+        # Spikes between uploads: min/max/mean/p95 of the local samples
+        "rollups": rates.get("rollups", {}),
+        "rollup_samples": rates.get("samples", 0),
+        "cadence": CADENCE.report(),
+        "collected_at": time.time(),
+        "bandwidth_probe": BANDWIDTH.cached(),
+        "system": {
+            "os": system.get("os"),
+            "boot_time": system.get("boot_time")
+        }
+    }
+    if "series" in rates:
+        extra["samples"] = rates["series"]  # One value per sampler tick
+    if METRICS.enabled and SELF_METRICS_IN_PAYLOAD:
+        extra["agent"] = METRICS.summary()
+
+    return {
+        "cpu_percent": round(rates.get("cpu_percent", 0), 2),
+        "ram_percent": round(memory.get("ram_percent", 0), 2),
+        "gpu_name": gpu_name,
+        "gpu_util": round(gpu_util, 2),
+        "gpu_temp": round(gpu_temp, 2),
+        "disk_usage_percent": round(usage.get(main_disk_path(), 0), 2),
+        # Observed network throughput over the sampler window
+        "net_up_mbps": round(rates.get("net_up_mbps", 0), 2),
+        "net_down_mbps": round(rates.get("net_down_mbps", 0), 2),
+        "extra": extra,
+    }
+
+# -------- Task Management --------
+# Per-type limits; anything not listed gets TASK_TIMEOUT and one slot
+TASK_TIMEOUTS = {
+    "flush_dns": 60,
+    "memory_optimization": 300,
+    "network_diagnosis": 300,
+    "clear_shader_cache": 600,
+    "clear_temp": 900,
+    "disk_cleanup": 1800,
+}
+TASK_CONCURRENCY = {
+    "flush_dns": 2,
+}
+
+_task_context = threading.local()
+
+def task_cancelled():
+    """True when the task running on this thread was cancelled or timed out"""
+    cancel = getattr(_task_context, "cancel", None)
+    return bool(cancel and cancel.is_set())
+
+def task_progress(message=None, percent=None, **fields):
+    """Report progress from inside a task; a no-op outside the task manager (e.g. --task)"""
+    progress = getattr(_task_context, "progress", None)
+    if progress is None:
+        return
+    event = dict(fields)
+    if message is not None:
+        event["message"] = message
+    if percent is not None:
+        event["percent"] = round(min(max(percent, 0.0), 100.0), 1)
+    progress.add(event)
+
+class TaskProgress:
+    """A running task's progress events, batched and sent at most every `interval` seconds
+
+    Events carry a sequence number, so the server can spot any dropped from
+    a full buffer. Servers without the events endpoint get the latest
+    state in the task's PUT instead. Uploads happen on a sender thread
+    started by the first event, so a slow server never stalls the task.
+    """
+
+    def __init__(self, device_id, task_id, interval=TASK_PROGRESS_INTERVAL, limit=TASK_PROGRESS_MAX_EVENTS):
+        self.device_id = device_id
+        self.task_id = task_id
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.sending = threading.Lock()  # One upload at a time: sender thread or _finish
+        self.pending = collections.deque(maxlen=limit)
+        self.latest = {}  # Every field's most recent value
+        self.seq = 0
+        self.closed = threading.Event()
+        self.thread = None
+
+    def add(self, event):
+        """Buffer an event; never blocks on the network"""
+        with self.lock:
+            if self.closed.is_set():
+                return  # A timed-out task still running; its result is already reported
+            self.seq += 1
+            event = {"seq": self.seq, "at": round(time.time(), 3), **event}
+            self.pending.append(event)
+            self.latest.update(event)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True,
+                                               name=f"task-{self.task_id}-progress")
+                self.thread.start()
+
+    def _loop(self):
+        # First event goes out at once, later ones at most every interval
+        while True:
+            self.flush()
+            if self.closed.wait(self.interval):
+                return
+
+    def close(self):
+        """Stop accepting events and send what is left"""
+        with self.lock:
+            self.closed.set()
+        return self.flush()
+
+    def flush(self):
+        """Send buffered events; on failure they stay buffered for the next flush"""
+        with self.sending:
+            with self.lock:
+                events = list(self.pending)
+                latest = dict(self.latest)
+            if not events:
+                return True
+            path = f"/api/device/{self.device_id}/tasks/{self.task_id}"
+            try:
+                if TRANSPORT.supports("task_events"):
+                    r = IDENTITY.check(TRANSPORT.post_json(path + "/events", events), not_found=False)
+                    if r.status_code in (404, 405):
+                        # Older server: keep operators informed through the task itself
+                        TRANSPORT.mark_missing("task_events")
+                if not TRANSPORT.supports("task_events"):
+                    r = TRANSPORT.put(path, json={"status": TaskStatus.RUNNING.value, "progress": latest})
+                r.raise_for_status()
+            except Exception as e:
+                print(f"⨯ Could not send progress for task {self.task_id}: {e}")
+                return False
+            with self.lock:
+                while self.pending and self.pending[0]["seq"] <= events[-1]["seq"]:
+                    self.pending.popleft()
+            return True
+
+def cap_result(output, limit=TASK_RESULT_MAX_BYTES):
+    """Output cut to at most limit UTF-8 bytes, keeping its head and tail"""
+    data = output.encode("utf-8", "replace")
+    if len(data) <= limit:
+        return output
+    marker = f"\n[... {len(data) - limit} bytes trimmed ...]\n"
+    head = limit * 3 // 4
+    tail = max(limit - head - len(marker), 0)
+    return (data[:head].decode("utf-8", "ignore") + marker
+            + (data[len(data) - tail:].decode("utf-8", "ignore") if tail else ""))
+
+def split_utf8(data, size):
+    """Split encoded text into strings of at most size bytes, never inside a character"""
+    chunks, start = [], 0
+    while start < len(data):
+        end = min(start + size, len(data))
+        while end < len(data) and end > start + 1 and data[end] & 0xC0 == 0x80:
+            end -= 1  # Back off a UTF-8 continuation byte
+        chunks.append(data[start:end].decode("utf-8", "replace"))
+        start = end
+    return chunks
+
+def upload_result(device_id, task_id, status, output, chunk_size=TASK_RESULT_CHUNK_BYTES):
+    """Final status and output, capped; output over one chunk is uploaded in pieces first
+
+    The status is always sent: if chunks cannot be uploaded, the output
+    goes in the PUT trimmed to one chunk instead.
+    """
+    output = cap_result(output)
+    data = output.encode("utf-8", "replace")
+    if len(data) > chunk_size and TRANSPORT.supports("task_result_chunks"):
+        chunks = split_utf8(data, chunk_size)
+        path = f"/api/device/{device_id}/tasks/{task_id}/result"
+        try:
+            for index, chunk in enumerate(chunks):
+                r = IDENTITY.check(
+                    TRANSPORT.post_json(path, {"index": index, "total": len(chunks), "data": chunk}),
+                    not_found=False,
+                )
+                if index == 0 and r.status_code in (404, 405):
+                    # Older server without chunked results
+                    TRANSPORT.mark_missing("task_result_chunks")
+                    break
+                r.raise_for_status()
+            else:
+                return update_task(device_id, task_id, status=status,
+                                   result_chunks=len(chunks), result_bytes=len(data))
+        except Exception as e:
+            print(f"⨯ Chunked result upload for task {task_id} failed, sending it trimmed: {e}")
+    return update_task(device_id, task_id, status=status, result=cap_result(output, chunk_size))
+
+class TaskStreamUnsupported(Exception):
+    pass
+
+SSE_LINE_END = re.compile(rb"\r\n|\r|\n")
+
+def sse_lines(chunks):
+    """Lines of an event stream, ended by CRLF, CR or LF as the SSE spec allows"""
+    buffer, after_cr = b"", False
+    for chunk in chunks:
+        if after_cr and chunk.startswith(b"\n"):
+            chunk = chunk[1:]  # Second half of a CRLF split across reads
+        buffer += chunk
+        *lines, buffer = SSE_LINE_END.split(buffer)
+        after_cr = bool(lines) and not buffer and chunk.endswith(b"\r")
+        yield from lines
+
+class TaskManager:
+    """Runs server tasks on a bounded worker pool, never blocking the metrics loop"""
+
+    def __init__(self, workers=TASK_WORKERS, poll_min=TASK_POLL_MIN, poll_max=TASK_POLL_MAX):
+        self.workers = workers
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.stream = None
+        self.lock = threading.Lock()
+        self.pool = None
+        self.active = {}  # task id -> {"type", "future", "cancel", "timer", "done", "deadline"}
+        self.finished = collections.deque(maxlen=256)  # Guards against re-running stale queued tasks
+        self.deferred = {}  # task id -> (device id, task) waiting for a TASK_CONCURRENCY slot
+        self.stop_flag = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread:
+            return
+        self.stop_flag.clear()
+        import concurrent.futures
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="task")
+        self.thread = threading.Thread(target=self._task_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_flag.set()
+        stream = self.stream
+        if stream is not None:
+            stream.close()  # Unblocks a pending stream read
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        for task_id in list(self.active):
+            self.cancel(task_id, "Agent shutting down")
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def _task_loop(self):
+        """Listen on the task stream; poll adaptively while it is unavailable"""
+        poll_delay = self.poll_min
+        next_stream_try = 0
+        while not self.stop_flag.is_set():
+            if BACKOFF.paused():
+                # Uploads found the server down; do not add to its load
+                self.stop_flag.wait(max(1.0, BACKOFF.remaining()))
+                continue
+            if time.monotonic() >= next_stream_try:
+                try:
+                    self._listen()
+                    # Stream closed by the server, reconnect, not all at once across the fleet
+                    self.stop_flag.wait(random.uniform(1, self.poll_min))
+                    continue
+                except TaskStreamUnsupported:
+                    print("ℹ️ Task stream not available, polling for tasks instead")
+                    next_stream_try = time.monotonic() + TASK_STREAM_RETRY
+                except Exception as e:
+                    if self.stop_flag.is_set():
+                        break
+                    print(f"Task stream error: {e}")
+                    next_stream_try = time.monotonic() + poll_delay
+
+            found = process_task_queue(self)
+            # Poll quickly while tasks are arriving, back off while idle
+            poll_delay = self.poll_min if found else min(poll_delay * 2, self.poll_max)
+            self.stop_flag.wait(poll_delay)
+
+    def _listen(self):
+        """Dispatch tasks pushed as server-sent events until the stream ends"""
+        device_id = IDENTITY.get_id()
+        r = TRANSPORT.get(
+            f"/api/device/{device_id}/tasks/stream",
+            headers={"Accept": "text/event-stream"},
+            timeout=(HTTP_CONNECT_TIMEOUT, TASK_STREAM_TIMEOUT),
+            stream=True,
+        )
+        with r:
+            if r.status_code in (404, 405, 501):
+                raise TaskStreamUnsupported()
+            IDENTITY.check(r, not_found=False)
+            r.raise_for_status()
+            self.stream = r
+            try:
+                print("✓ Listening for tasks")
+                # Catch up on anything queued while we were not connected
+                process_task_queue(self)
+                event, data = "message", []
+                # chunk_size=1 hands each line over as soon as it arrives
+                for raw in sse_lines(r.iter_content(chunk_size=1)):
+                    if self.stop_flag.is_set():
+                        break
+                    line = raw.decode("utf-8", "replace")
+                    if not line:
+                        if data:
+                            self._on_event(device_id, event, "\n".join(data))
+                        event, data = "message", []
+                    elif line.startswith(":"):
+                        continue  # Heartbeat
+                    else:
+                        field, _, value = line.partition(":")
+                        value = value[1:] if value.startswith(" ") else value
+                        if field == "event":
+                            event = value
+                        elif field == "data":
+                            data.append(value)
+            finally:
+                self.stream = None
+
+    def _on_event(self, device_id, event, data):
+        try:
+            message = json.loads(data)
+        except ValueError:
+            print(f"⨯ Bad task event: {data[:100]}")
+            return
+        if not isinstance(message, dict) or message.get("id") is None:
+            return  # Nothing to act on; dropping the stream over it would cost a reconnect
+        if event == "task":
+            if message.get("type") in TASKS:
+                self.submit(device_id, message)
+            else:
+                print(f"⨯ Unknown task type: {message.get('type')}")
+        elif event == "cancel":
+            self.cancel(message.get("id"))
+
+    def running_count(self, task_type):
+        return sum(1 for entry in self.active.values() if entry["type"] == task_type)
+
+    def submit(self, device_id, task):
+        """Queue a server task; returns False if it is already known or over its limit"""
+        task_id, task_type = task["id"], task["type"]
+        with self.lock:
+            if task_id in self.active or task_id in self.finished:
+                return False
+            if self.running_count(task_type) >= TASK_CONCURRENCY.get(task_type, 1):
+                # No poll comes while the stream is up; started from _finish when a slot frees
+                self.deferred.setdefault(task_id, (device_id, task))
+                return False
+            self.deferred.pop(task_id, None)
+            # The clock starts now, so a task stuck behind hung workers still times out
+            timeout = TASK_TIMEOUTS.get(task_type, TASK_TIMEOUT)
+            entry = {"type": task_type, "device_id": device_id, "cancel": threading.Event(),
+                     "done": False, "deadline": time.monotonic() + timeout}
+            entry["timer"] = threading.Timer(
+                timeout, self._finish,
+                args=(device_id, task_id, entry, TaskStatus.FAILED.value, f"Timed out after {timeout}s"),
+            )
+            entry["timer"].daemon = True
+            self.active[task_id] = entry
+            entry["future"] = self.pool.submit(self._run, device_id, task, entry)
+            entry["timer"].start()
+        return True
+
+    def cancel(self, task_id, reason="Cancelled"):
+        """Cancel a queued or running task; running tasks stop at their next check"""
+        with self.lock:
+            entry = self.active.get(task_id)
+            deferred = self.deferred.pop(task_id, None)
+        if deferred:
+            try:
+                update_task(deferred[0], task_id, status=TaskStatus.FAILED.value, result=reason)
+            except Exception as e:
+                print(f"⨯ Failed to update task {task_id} status: {e}")
+            with self.lock:
+                self.finished.append(task_id)
+            return True
+        if not entry:
+            return False
+        entry["cancel"].set()
+        entry["future"].cancel()
+        self._finish(entry["device_id"], task_id, entry, TaskStatus.FAILED.value, reason)
+        return True
+
+    def _run(self, device_id, task, entry):
+        task_id, task_type = task["id"], task["type"]
+        if entry["cancel"].is_set():
+            return
+        try:
+            update_task(device_id, task_id, status=TaskStatus.RUNNING.value)
+        except Exception as e:
+            print(f"⨯ Failed to mark task {task_id} as running: {e}")
+            # Not reported or marked finished, so the server can hand it out again
+            self._release(task_id, entry, finished=False)
+            return
 
-class TaskStatus(str, enum.Enum):
-    QUEUED = "queued"
-    RUNNING = "running"
-    COMPLETED = "completed"
-    FAILED = "failed"
+        print(f"▶️ Starting task {task_id}: {task_type}")
+        entry["started"] = time.perf_counter()
+        entry["progress"] = TaskProgress(device_id, task_id)
+        _task_context.cancel = entry["cancel"]
+        _task_context.deadline = entry["deadline"]
+        _task_context.progress = entry["progress"]
+        try:
+            output = TASKS[task_type]()
+            status = TaskStatus.COMPLETED.value
+        except Exception as e:
+            output = str(e)
+            status = TaskStatus.FAILED.value
+        finally:
+            _task_context.cancel = None
+            _task_context.deadline = None
+            _task_context.progress = None
+        self._finish(device_id, task_id, entry, status, output)
 
-load_dotenv(dotenv_path=Path(__file__).with_name(".env"))
+    def _release(self, task_id, entry, finished=True):
+        """Free a task's slot exactly once and start a deferred task of its type; False if already freed"""
+        with self.lock:
+            if entry["done"]:
+                return False
+            entry["done"] = True
+            entry["cancel"].set()  # Tells a timed-out task to give up
+            entry["timer"].cancel()
+            entry["future"].cancel()  # Never starts if it was still waiting for a worker
+            self.active.pop(task_id, None)
+            if finished:
+                self.finished.append(task_id)
+            waiting = next((item for item in self.deferred.values() if item[1]["type"] == entry["type"]), None)
+        if waiting and not self.stop_flag.is_set():
+            self.submit(*waiting)  # Take the slot this task held
+        return True
 
-SERVER_URL = os.getenv("SERVER_URL", "http://127.0.0.1:8000")
-DEVICE_KEY = os.getenv("DEVICE_KEY", "CHANGE_ME_DEVICE_KEY")
-DEVICE_NAME = os.getenv("DEVICE_NAME", "New Device")
+    def _finish(self, device_id, task_id, entry, status, output):
+        """Report a task exactly once, whichever of worker, timeout or cancel gets here first"""
+        if not self._release(task_id, entry):
+            return
 
-HEADERS = {"X-Device-Key": DEVICE_KEY}
+        if "started" in entry:
+            METRICS.observe("agent_task_seconds", time.perf_counter() - entry["started"],
+                            type=entry["type"], status=status)
+        output = cap_result(output)
+        if status == TaskStatus.COMPLETED.value:
+            print(f"✓ Task {task_id} completed successfully:")
+            for line in output.splitlines():
+                print(f"  {line}")
+        else:
+            print(f"⨯ Task {task_id} failed: {output}")
+        if entry.get("progress"):
+            entry["progress"].close()  # Progress lands before the final status
+        try:
+            upload_result(device_id, task_id, status, output)
+        except Exception as e:
+            print(f"⨯ Failed to update task {task_id} status: {e}")
 
-def win():
-    return os.name == "nt"
 
-def run(cmd):
-    try:
-        out = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT, text=True)
-        return out.strip()
-    except subprocess.CalledProcessError as e:
-        return e.output.strip()
+# -------- Cleanup Engine --------
+class ScanDir:
+    """A directory in a cleanup walk; finished once its listing, files and subdirectories are"""
 
-def get_gpu_info():
-    try:
-        import GPUtil
-        gpus = GPUtil.getGPUs()
-        if gpus:
-            gpu = gpus[0]  # Get first GPU
-            return gpu.name, gpu.load * 100, gpu.temperature
-    except Exception:
-        # Try Nvidia via nvidia-smi as fallback
-        if win():
-            try:
-                q = run('nvidia-smi --query-gpu=name,utilization.gpu,temperature.gpu --format=csv,noheader,nounits')
-                if q:
-                    parts = [p.strip() for p in q.split(",")]
-                    name = parts[0]
-                    util = float(parts[1]) if len(parts) > 1 else 0.0
-                    temp = float(parts[2]) if len(parts) > 2 else 0.0
-                    return name, util, temp
-            except Exception:
-                pass
-    # Fallbacks
-    return "Unknown", 0.0, 0.0
+    __slots__ = ("path", "parent", "pending")
 
-def get_net_speeds_mbps():
-    """Get network speeds using speedtest-cli or psutil as fallback"""
-    try:
-        import speedtest
-        s = speedtest.Speedtest()
-        s.get_best_server()
-        down = s.download() / 1_000_000  # Convert to Mbps
-        up = s.upload() / 1_000_000  # Convert to Mbps
-        return round(up, 2), round(down, 2)
-    except Exception:
-        # Fallback to psutil
-        c1 = psutil.net_io_counters()
-        time.sleep(1.0)
-        c2 = psutil.net_io_counters()
-        up = (c2.bytes_sent - c1.bytes_sent) * 8 / 1_000_000
-        down = (c2.bytes_recv - c1.bytes_recv) * 8 / 1_000_000
-        return round(up, 2), round(down, 2)
+    def __init__(self, path, parent=None):
+        self.path = path
+        self.parent = parent
+        self.pending = 1  # The listing itself; each yielded file and subdirectory adds one
+        if parent:
+            parent.pending += 1
 
-def collect_metrics():
-    # CPU metrics with per-core info
-    cpu_overall = psutil.cpu_percent(interval=0.5)
-    cpu_per_core = psutil.cpu_percent(interval=0.1, percpu=True)
-    cpu_freq = psutil.cpu_freq()
+    def done(self, on_finished=None):
+        """Count one child as handled; on_finished(path) runs post-order for each directory that finishes"""
+        node = self
+        node.pending -= 1
+        while node.pending == 0:
+            if on_finished:
+                on_finished(node.path)
+            node = node.parent
+            if node is None:
+                break
+            node.pending -= 1
 
-    # Memory metrics
-    vm = psutil.virtual_memory()
-    swap = psutil.swap_memory()
+def scan_files(root, min_age=0, patterns=None, now=None, on_finished=None):
+    """Yield (path, size, dir) for files under root, reusing each scandir stat result
 
-    # Disk metrics for all mounted drives
-    disk_metrics = {}
-    for part in psutil.disk_partitions(all=False):
-        if part.fstype:  # Skip empty drives
-            try:
-                usage = psutil.disk_usage(part.mountpoint)
-                disk_metrics[part.mountpoint] = {
-                    "total_gb": usage.total / (1024**3),
-                    "used_percent": usage.percent
-                }
-            except Exception:
-                continue
+    Call dir.done(on_finished) once each file is handled; on_finished then sees every
+    directory after its contents, so empty ones can be removed in the same pass.
+    """
+    now = now or time.time()
+    stack = [ScanDir(root)]
+    while stack:
+        if task_cancelled():
+            return
+        node = stack.pop()
+        try:
+            it = os.scandir(node.path)
+        except OSError:
+            node.done(on_finished)
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(ScanDir(entry.path, node))
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if patterns and not any(fnmatch.fnmatch(entry.name, p) for p in patterns):
+                    continue
+                if min_age and now - st.st_mtime < min_age:
+                    continue
+                node.pending += 1
+                yield entry.path, st.st_size, node
+        node.done(on_finished)
 
-    # GPU metrics
-    gpu_name, gpu_util, gpu_temp = get_gpu_info()
+def _remove_files(batch):
+    files = size = errors = 0
+    for path, file_size, _ in batch:
+        try:
+            os.remove(path)
+            files += 1
+            size += file_size
+        except OSError:
+            errors += 1  # In use or access denied
+    return files, size, errors
 
-    # Network speeds - get average over a short period
-    up, down = get_net_speeds_mbps()
+def clean_paths(targets, min_age=None, patterns=None, dry_run=None, remove_empty_dirs=False,
+                workers=CLEANUP_WORKERS, batch_size=256):
+    """Delete matching files under each target; returns exact bytes per target
 
-    # Enhanced process metrics
-    top_processes = []
-    try:
-        processes = list(psutil.process_iter(["name", "cpu_percent", "memory_percent"]))
-        processes.sort(key=lambda p: p.info.get("cpu_percent", 0), reverse=True)
-        for proc in processes[:5]:  # Get top 5 CPU-consuming processes
-            try:
-                top_processes.append({
-                    "name": proc.info["name"],
-                    "cpu_percent": proc.info["cpu_percent"],
-                    "memory_percent": proc.info.get("memory_percent", 0)
-                })
-            except Exception:
+    Deletion runs in a bounded thread pool and only successfully removed files
+    are counted. With dry_run nothing is deleted and matches are counted instead.
+    Empty directories are removed in the same walk, each once its files are gone.
+    """
+    min_age = CLEANUP_MIN_AGE if min_age is None else min_age
+    dry_run = CLEANUP_DRY_RUN if dry_run is None else dry_run
+    import concurrent.futures
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for target in targets:
+            if not target or not os.path.isdir(target) or target in results:
                 continue
-    except Exception:
-        pass
+            stats = {"files": 0, "bytes": 0, "errors": 0}
+            pending = collections.deque()
+            reported = time.monotonic()
 
-    # Get main disk usage (C: on Windows, / on Linux)
-    main_disk = psutil.disk_usage("C:\\" if win() else "/")
+            def remove_dir(path, target=target):
+                if path != target:
+                    try:
+                        os.rmdir(path)
+                    except OSError:
+                        pass  # Not empty: something in it was kept or could not be removed
 
-    extra = {
-        "num_processes": len(psutil.pids()),
-        "top_processes": top_processes,
-        "cpu_info": {
-            "per_core": cpu_per_core,
-            "frequency_mhz": cpu_freq.current if cpu_freq else 0,
-            "max_frequency_mhz": cpu_freq.max if cpu_freq else 0
-        },
-        "memory_info": {
-            "total_gb": vm.total / (1024**3),
-            "available_gb": vm.available / (1024**3),
-            "swap_used_percent": swap.percent
-        },
-        "disk_info": disk_metrics,
-        "system": {
-            "os": "windows" if win() else "linux",
-            "boot_time": psutil.boot_time()
-        }
-    }
+            on_finished = remove_dir if remove_empty_dirs and not dry_run else None
 
-    payload = {
-        "cpu_percent": round(cpu_overall, 2),
-        "ram_percent": round(vm.percent, 2),
-        "gpu_name": gpu_name,
-        "gpu_util": round(gpu_util, 2),
-        "gpu_temp": round(gpu_temp, 2),
-        "disk_usage_percent": round(main_disk.percent, 2),
-        "net_up_mbps": up,
-        "net_down_mbps": down,
-        "extra": extra,
-    }
+            def collect(future, batch):
+                nonlocal reported
+                files, size, errors = future.result()
+                stats["files"] += files
+                stats["bytes"] += size
+                stats["errors"] += errors
+                for _, _, node in batch:
+                    node.done(on_finished)
+                if time.monotonic() - reported >= 1:
+                    reported = time.monotonic()
+                    task_progress(target=target, files=stats["files"], bytes_freed=stats["bytes"])
 
-    payload = {
-        "cpu_percent": round(cpu_overall, 2),
-        "ram_percent": round(vm.percent, 2),
-        "gpu_name": gpu_name,
-        "gpu_util": round(gpu_util, 2),
-        "gpu_temp": round(gpu_temp, 2),
-        "disk_usage_percent": round(main_disk.percent, 2),
-        "net_up_mbps": up,
-        "net_down_mbps": down,
-        "extra": extra,
-    }
-    return payload
-    return payload
+            batch = []
+            for item in scan_files(target, min_age, patterns, on_finished=on_finished):
+                if dry_run:
+                    stats["files"] += 1
+                    stats["bytes"] += item[1]
+                    continue
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    pending.append((pool.submit(_remove_files, batch), batch))
+                    batch = []
+                    # Keep memory bounded on huge trees
+                    while len(pending) > workers * 2:
+                        collect(*pending.popleft())
+            if batch:
+                pending.append((pool.submit(_remove_files, batch), batch))
+            while pending:
+                collect(*pending.popleft())
+            results[target] = stats
+            task_progress(f"Finished {target}", target=target, files=stats["files"], bytes_freed=stats["bytes"])
+    return results
 
-# -------- Task Management --------
-class TaskManager:
-    def __init__(self):
-        self.current_task = None
-        self.stop_flag = False
-        self.thread = None
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.2f} {unit}"
+        n /= 1024
 
-    def start(self):
-        self.stop_flag = False
-        self.thread = threading.Thread(target=self._task_loop)
-        self.thread.daemon = True
-        self.thread.start()
+def summarize_cleanup(results, what, dry_run=None):
+    """One-line summary; pass the dry_run given to clean_paths"""
+    dry_run = CLEANUP_DRY_RUN if dry_run is None else dry_run
+    files = sum(r["files"] for r in results.values())
+    size = sum(r["bytes"] for r in results.values())
+    verb = "Would clear" if dry_run else "Cleared"
+    return f"{verb} {files} {what} ({format_bytes(size)})"
 
-    def stop(self):
-        self.stop_flag = True
-        if self.thread:
-            self.thread.join()
+def temp_dirs():
+    return [os.environ.get("TEMP"), os.environ.get("TMP"), "C:\\Windows\\Temp"]
 
-    def _task_loop(self):
-        while not self.stop_flag:
-            try:
-                # Check for queued tasks
-                response = requests.get(
-                    f"{SERVER_URL}/api/device/me",
-                    headers=HEADERS
-                )
-                device_info = response.json()
-                device_id = device_info["id"]
+def shader_cache_dirs():
+    # Common shader cache directories. Adjust as needed.
+    return [
+        os.path.expandvars(r"%LOCALAPPDATA%\NVIDIA\DXCache"),
+        os.path.expandvars(r"%LOCALAPPDATA%\D3DSCache"),
+        os.path.expandvars(r"%LOCALAPPDATA%\NVIDIA\GLCache"),
+    ]
 
-                response = requests.get(
-                    f"{SERVER_URL}/api/device/{device_id}/tasks?status=queued",
-                    headers=HEADERS
-                )
-                
-                if response.status_code == 200:
-                    tasks = response.json()
-                    for task in tasks:
-                        if self.stop_flag:
-                            break
-                        
-                        # Update task to running
-                        self.current_task = task
-                        requests.put(
-                            f"{SERVER_URL}/api/device/{device_id}/tasks/{task['id']}",
-                            headers=HEADERS,
-                            json={"status": "running"}
-                        )
-
-                        # Execute task
-                        try:
-                            result = self._execute_task(task)
-                            status = "completed"
-                        except Exception as e:
-                            result = f"Error: {str(e)}"
-                            status = "failed"
-
-                        # Update task with result
-                        requests.put(
-                            f"{SERVER_URL}/api/device/{device_id}/tasks/{task['id']}",
-                            headers=HEADERS,
-                            json={"status": status, "result": result}
-                        )
-
-                        self.current_task = None
+# -------- Network Probes --------
+PROBE_PHASES = ("dns_ms", "connect_ms", "tls_ms", "first_byte_ms", "total_ms")
 
-            except Exception as e:
-                print(f"Task loop error: {e}")
+def resolve(host, port, timeout):
+    """getaddrinfo within timeout; the lookup cannot be interrupted, so it runs on a daemon thread"""
+    result = {}
 
-            # Wait before checking again
-            for _ in range(30):  # 30 second interval
-                if self.stop_flag:
-                    break
-                time.sleep(1)
+    def lookup():
+        try:
+            result["addresses"] = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except Exception as e:
+            result["error"] = e
 
-    def _execute_task(self, task):
-        task_type = task["type"]
-        
-        if task_type == "disk_cleanup":
-            return self._disk_cleanup()
-        elif task_type == "memory_optimization":
-            return self._memory_optimization()
-        elif task_type == "network_diagnosis":
-            return self._network_diagnosis()
-        elif task_type == "flush_dns":
-            return flush_dns()
-        elif task_type == "clear_temp":
-            return clear_temp()
-        elif task_type == "clear_shader_cache":
-            return clear_shader_cache()
+    thread = threading.Thread(target=lookup, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f"DNS lookup for {host} timed out after {timeout}s")
+    if "error" in result:
+        raise result["error"]
+    return result["addresses"]
+
+def probe_once(url, timeout=NETWORK_PROBE_TIMEOUT):
+    """Time DNS lookup, TCP connect, TLS handshake and first byte of one request"""
+    parts = urllib.parse.urlsplit(url)
+    https = parts.scheme == "https"
+    host = parts.hostname
+    default_port = 443 if https else 80
+    port = parts.port or default_port
+    host_header = f"[{host}]" if ":" in host else host  # IPv6 literals keep their brackets
+    if port != default_port:
+        host_header += f":{port}"
+    timings = {}
+    start = mark = time.perf_counter()
+
+    def phase(name):
+        nonlocal mark
+        now = time.perf_counter()
+        timings[name] = (now - mark) * 1000
+        mark = now
+
+    family, socktype, proto, _, address = resolve(host, port, timeout)[0]
+    phase("dns_ms")
+    sock = socket.socket(family, socktype, proto)
+    # What the lookup left of the budget
+    sock.settimeout(max(timeout - (time.perf_counter() - start), 0.001))
+    try:
+        sock.connect(address)
+        phase("connect_ms")
+        if https:
+            import ssl
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+            phase("tls_ms")
         else:
-            raise ValueError(f"Unknown task type: {task_type}")
+            timings["tls_ms"] = 0.0
+        request = (f"HEAD {parts.path or '/'} HTTP/1.1\r\nHost: {host_header}\r\n"
+                   f"User-Agent: health-agent/{AGENT_VERSION}\r\nConnection: close\r\n\r\n")
+        sock.sendall(request.encode())
+        if not sock.recv(1):
+            raise ConnectionError("Connection closed before response")
+        phase("first_byte_ms")
+    finally:
+        sock.close()
+    timings["total_ms"] = (time.perf_counter() - start) * 1000
+    return timings
 
+def run_probes(targets=NETWORK_PROBE_TARGETS, samples=NETWORK_PROBE_SAMPLES, timeout=NETWORK_PROBE_TIMEOUT):
+    """Probe every target several times at once; returns min/median/p95 per phase and loss"""
+    import concurrent.futures
+    import statistics
+    jobs = [(target, i) for target in targets for i in range(samples)]
+    outcomes = {target: [] for target in targets}
+    errors = {target: [] for target in targets}
+    # Every probe runs concurrently, so the whole run takes as long as the slowest one
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(jobs), 32))) as pool:
+        futures = {pool.submit(probe_once, target, timeout): target for target, _ in jobs}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            target = futures[future]
+            try:
+                outcomes[target].append(future.result())
+                task_progress(percent=60 * done / len(jobs), probe=target,
+                              total_ms=round(outcomes[target][-1]["total_ms"], 1))
+            except Exception as e:
+                errors[target].append(str(e))
+                task_progress(percent=60 * done / len(jobs), probe=target, error=str(e))
 
+    report = {}
+    for target in targets:
+        ok = outcomes[target]
+        summary = {"samples": samples, "loss_percent": round(100 * (samples - len(ok)) / samples, 1)}
+        for name in PROBE_PHASES:
+            values = sorted(t[name] for t in ok)
+            summary[name] = {
+                "min": round(values[0], 1),
+                "median": round(statistics.median(values), 1),
+                "p95": round(percentile(values, 95), 1),
+            } if values else None
+        if errors[target]:
+            summary["error"] = errors[target][0]
+        report[target] = summary
+    return report
 
 # -------- Maintenance Tasks (safe) --------
 def disk_cleanup():
     """Comprehensive disk cleanup task"""
     results = []
+    freed = 0
     
-    # Get initial disk space
-    disk = psutil.disk_usage("C:\\") if win() else psutil.disk_usage("/")
-    space_before = disk.used / (1024**3)  # Convert to GB
-    
-    # Clear temp files
-    temp_result = clear_temp()
-    results.append(f"Temp cleanup: {temp_result}")
-    
-    # Clear Windows Update cache if on Windows
     if win():
+        # Clear temp files
+        task_progress("Clearing temp files", percent=0)
+        temp = clean_paths(temp_dirs())
+        freed += sum(r["bytes"] for r in temp.values())
+        results.append(f"Temp cleanup: {summarize_cleanup(temp, 'temp files')}")
+
+        # Clear Windows Update cache
+        task_progress("Clearing Windows Update cache", percent=50, bytes_freed=freed)
         try:
             update_path = os.path.expandvars("%SystemRoot%\\SoftwareDistribution\\Download")
-            if os.path.exists(update_path):
-                size_before = sum(os.path.getsize(os.path.join(dirpath, f))
-                    for dirpath, _, filenames in os.walk(update_path)
-                    for f in filenames) / (1024**3)  # Convert to GB
-                shutil.rmtree(update_path, ignore_errors=True)
-                results.append(f"Cleared Windows Update cache ({size_before:.2f} GB)")
+            update = clean_paths([update_path], remove_empty_dirs=True)
+            freed += sum(r["bytes"] for r in update.values())
+            results.append(f"Windows Update cache: {summarize_cleanup(update, 'files')}")
         except Exception as e:
             results.append(f"Windows Update cleanup error: {e}")
+    else:
+        results.append("Temp cleanup: Clear temp implemented for Windows only")
 
-    # Calculate total space saved
+    # Space saved is counted per deleted file, not diffed from noisy disk usage
     disk = psutil.disk_usage("C:\\") if win() else psutil.disk_usage("/")
-    space_after = disk.used / (1024**3)
-    space_saved = space_before - space_after
-    results.append(f"\nTotal space saved: {space_saved:.2f} GB")
+    results.append(f"\nTotal space saved: {format_bytes(freed)}")
     results.append(f"Disk usage: {disk.percent}%")
 
     return "\n".join(results)
@@ -317,24 +2631,31 @@ def memory_optimization():
     before_used = mem.used / (1024**3)  # Convert to GB
     before_percent = mem.percent
     
-    if win():
-        # Get top memory-using processes
-        processes = []
-        for proc in psutil.process_iter(['name', 'memory_percent']):
+    # Top memory users from the process tracker's last scan, not a fresh full scan
+    rows = PROCESSES.rows or PROCESSES.refresh()
+    processes = [row for row in PROCESSES.top(3, "memory_percent", rows) if row["memory_percent"] > 1.0]
+    if processes:
+        results.append("Top memory-using processes before optimization:")
+        for row in processes:
+            results.append(f"  {row['name']}: {row['memory_percent']:.1f}%")
+        results.append("")
+
+    suspects = MEMORY_HISTORY.suspects()
+    if suspects:
+        results.append("Possible memory leaks (steady growth):")
+        for row in suspects:
             try:
-                pinfo = proc.info
-                if pinfo['memory_percent'] > 1.0:  # Only processes using >1% memory
-                    processes.append((pinfo['name'], pinfo['memory_percent']))
-            except Exception:
-                pass
-        
-        if processes:
-            processes.sort(key=lambda x: x[1], reverse=True)
-            results.append("Top memory-using processes before optimization:")
-            for name, mem_percent in processes[:3]:
-                results.append(f"  {name}: {mem_percent:.1f}%")
-            results.append("")
-        
+                # USS only for the few suspects: it needs a full page-map walk
+                uss = f", {psutil.Process(row['pid']).memory_full_info().uss / 1024**2:.0f} MB unique"
+            except (psutil.Error, AttributeError):
+                uss = ""
+            results.append(
+                f"  {row['name']} (pid {row['pid']}): {row['rss_mb']:.0f} MB{uss}, "
+                f"+{row['growth_mb_per_hour']:.1f} MB/h over {row['tracked_hours']:.1f} h")
+        results.append("")
+
+    if win():
+        task_progress("Trimming browser working sets", percent=40)
         # Empty working set of known memory-heavy processes
         memory_heavy = ['chrome.exe', 'firefox.exe', 'msedge.exe', 'brave.exe']
         for proc in memory_heavy:
@@ -370,22 +2691,24 @@ def network_diagnosis():
     """Network diagnosis task"""
     results = []
     
-    # Test DNS resolution
-    dns_servers = ["1.1.1.1", "8.8.8.8", "9.9.9.9"]
-    results.append("DNS Resolution Test:")
-    for server in dns_servers:
-        try:
-            start = time.time()
-            response = requests.get(f"https://{server}", timeout=5)
-            latency = (time.time() - start) * 1000
-            results.append(f"  {server}: OK ({latency:.1f}ms)")
-        except Exception as e:
-            results.append(f"  {server}: Failed ({str(e)})")
+    # Connectivity probes, timed per phase (min/median/p95 in ms)
+    results.append(f"Connectivity Test ({NETWORK_PROBE_SAMPLES} samples per target, min/median/p95 ms):")
+    for target, summary in run_probes().items():
+        if summary["total_ms"] is None:
+            results.append(f"  {target}: Failed ({summary.get('error', 'no response')})")
+            continue
+        results.append(f"  {target}: loss {summary['loss_percent']:.0f}%")
+        for name in PROBE_PHASES:
+            phase = summary[name]
+            label = name[:-3].replace("_", " ")
+            results.append(f"    {label:<11} {phase['min']:.1f} / {phase['median']:.1f} / {phase['p95']:.1f}")
     
-    # Speed test
+    # Speed test (on demand, also refreshes the cached bandwidth probe)
+    task_progress("Running speed test", percent=60)
     results.append("\nNetwork Speed Test:")
     try:
-        up, down = get_net_speeds_mbps()
+        probe = BANDWIDTH.run()
+        up, down = probe["up_mbps"], probe["down_mbps"]
         quality = "Excellent" if min(up, down) > 100 else "Good" if min(up, down) > 25 else "Fair" if min(up, down) > 10 else "Poor"
         results.append(f"  Upload: {up:.1f} Mbps")
         results.append(f"  Download: {down:.1f} Mbps")
@@ -395,6 +2718,7 @@ def network_diagnosis():
     
     if win():
         # Get network adapter info
+        task_progress("Listing network adapters", percent=90)
         results.append("\nNetwork Adapters:")
         netsh = run("netsh interface ipv4 show interfaces")
         for line in netsh.splitlines():
@@ -423,43 +2747,12 @@ def flush_dns():
 def clear_temp():
     if not win():
         return "Clear temp implemented for Windows only"
-    cleared = 0
-    for path in [os.environ.get("TEMP"), os.environ.get("TMP"), "C:\\Windows\\Temp"]:
-        if not path: 
-            continue
-        try:
-            for root, dirs, files in os.walk(path):
-                for f in files:
-                    fp = os.path.join(root, f)
-                    try:
-                        os.remove(fp)
-                        cleared += 1
-                    except Exception:
-                        pass
-        except Exception:
-            pass
-    return f"Cleared ~{cleared} temp files"
+    return summarize_cleanup(clean_paths(temp_dirs()), "temp files")
 
 def clear_shader_cache():
     if not win():
         return "Shader cache clear implemented for Windows only"
-    # Common shader cache directories. Adjust as needed.
-    paths = [
-        os.path.expandvars(r"%LOCALAPPDATA%\NVIDIA\DXCache"),
-        os.path.expandvars(r"%LOCALAPPDATA%\D3DSCache"),
-        os.path.expandvars(r"%LOCALAPPDATA%\NVIDIA\GLCache"),
-    ]
-    cleared = 0
-    for p in paths:
-        if p and os.path.isdir(p):
-            for root, dirs, files in os.walk(p):
-                for f in files:
-                    try:
-                        os.remove(os.path.join(root, f))
-                        cleared += 1
-                    except Exception:
-                        pass
-    return f"Cleared ~{cleared} shader cache files"
+    return summarize_cleanup(clean_paths(shader_cache_dirs()), "shader cache files")
 
 TASKS = {
     "disk_cleanup": disk_cleanup,
@@ -470,92 +2763,55 @@ TASKS = {
     "clear_shader_cache": clear_shader_cache,
 }
 
-def process_task_queue():
-    """Poll for pending tasks and execute them"""
+def update_task(device_id, task_id, **fields):
+    r = TRANSPORT.put(f"/api/device/{device_id}/tasks/{task_id}", json=fields)
+    r.raise_for_status()
+    return r
+
+@METRICS.timed("agent_task_poll_seconds")
+def process_task_queue(manager=None):
+    """Poll for pending tasks and hand them to the task executor; returns how many were found"""
+    manager = manager or TASK_MANAGER
     try:
-        # Get device ID first if we don't have it
-        if not hasattr(process_task_queue, "device_id"):
-            r = requests.get(f"{SERVER_URL}/api/device/me", headers=HEADERS)
-            if r.status_code == 200:
-                process_task_queue.device_id = r.json()["id"]
-                print(f"✓ Got device ID: {process_task_queue.device_id}")
-            else:
-                print(f"Failed to get device ID: {r.status_code}")
-                return
-        
+        device_id = IDENTITY.get_id()
+
         # Get pending tasks
-        r = requests.get(
-            f"{SERVER_URL}/api/device/{process_task_queue.device_id}/tasks?status=queued",
-            headers=HEADERS
-        )
+        r = IDENTITY.check(TRANSPORT.get(f"/api/device/{device_id}/tasks?status=queued"))
         if r.status_code != 200:
             print(f"Failed to get tasks: {r.status_code}")
-            return
+            return 0
             
         tasks = r.json()
         if tasks:
             print(f"Found {len(tasks)} queued tasks")
             
         for task in tasks:
-            task_id = task["id"]
-            task_type = task["type"]
-            
-            if task_type not in TASKS:
-                print(f"⨯ Unknown task type: {task_type}")
-                continue
-                
-            print(f"▶️ Starting task {task_id}: {task_type}")
-            
-            # Mark as running
-            try:
-                r = requests.put(
-                    f"{SERVER_URL}/api/device/{process_task_queue.device_id}/tasks/{task_id}",
-                    json={"status": TaskStatus.RUNNING.value},
-                    headers=HEADERS
-                )
-                r.raise_for_status()
-            except Exception as e:
-                print(f"⨯ Failed to mark task {task_id} as running: {e}")
+            if task["type"] not in TASKS:
+                print(f"⨯ Unknown task type: {task['type']}")
                 continue
-            
-            try:
-                # Run the task
-                output = TASKS[task_type]()
-                status = TaskStatus.COMPLETED.value
-                print(f"✓ Task {task_id} completed successfully:")
-                for line in output.splitlines():
-                    print(f"  {line}")
-            except Exception as e:
-                output = str(e)
-                status = TaskStatus.FAILED.value
-                print(f"⨯ Task {task_id} failed: {e}")
-                
-            # Update task status
-            try:
-                r = requests.put(
-                    f"{SERVER_URL}/api/device/{process_task_queue.device_id}/tasks/{task_id}",
-                    json={"status": status, "result": output},
-                    headers=HEADERS
-                )
-                r.raise_for_status()
-            except Exception as e:
-                print(f"⨯ Failed to update task {task_id} status: {e}")
+            manager.submit(device_id, task)
+        return len(tasks)
             
     except Exception as e:
         print(f"Error processing tasks: {e}")
+        return 0
+
+TASK_MANAGER = TaskManager()
 
 def ensure_device_registered():
     """Make sure we have a valid device key and are registered with the server"""
-    global DEVICE_KEY, HEADERS
+    global DEVICE_KEY
     
     if DEVICE_KEY == "CHANGE_ME_DEVICE_KEY":
         print("ℹ️ First run - registering device...")
         try:
-            r = requests.post(f"{SERVER_URL}/api/register", data={"name": DEVICE_NAME})
+            # Registration is anonymous, so drop the placeholder key header
+            r = TRANSPORT.post("/api/register", data={"name": DEVICE_NAME},
+                               headers={"X-Device-Key": None})
             if r.status_code == 200:
                 device = r.json()
                 DEVICE_KEY = device["device_key"]
-                HEADERS["X-Device-Key"] = DEVICE_KEY
+                IDENTITY.set_key(DEVICE_KEY, device.get("id"))
                 
                 # Save to .env file
                 env_file = Path(__file__).with_name(".env")
@@ -571,57 +2827,534 @@ def ensure_device_registered():
             return False
     return True
 
-def send_metrics_with_backoff(initial_delay=1, max_delay=300):
-    """Send metrics with exponential backoff on failure"""
-    delay = initial_delay
-    device_id = None
-    
+def upload_metrics(device_id, payload):
+    """POST one sample, as a delta frame while the server accepts them"""
+    global ENCODER
+    path = f"/api/device/{device_id}/metrics"
+    encoder = ENCODER  # The policy thread may swap ENCODER mid-upload
+    if encoder is None:
+        return TRANSPORT.post_json(path, payload)
+    try:
+        r = TRANSPORT.post_json(path, encoder.encode(payload), content_type=DELTA_CONTENT_TYPE)
+        if r.status_code == 409:
+            # Server lost our base (restart, failover); resend as a keyframe
+            encoder.reset()
+            r = TRANSPORT.post_json(path, encoder.encode(payload), content_type=DELTA_CONTENT_TYPE)
+    except Exception:
+        encoder.reset()
+        raise
+    if r.status_code in (400, 415, 422):
+        print("ℹ️ Server does not accept delta payloads, sending full JSON")
+        if ENCODER is encoder:
+            ENCODER = None
+        return TRANSPORT.post_json(path, payload)
+    if r.status_code == 200:
+        encoder.commit()
+    else:
+        encoder.reset()
+    return r
+
+def drain_spool(device_id, max_batches=SPOOL_MAX_BATCHES):
+    """Replay spooled samples oldest-first in batched uploads"""
+    sent = 0
+    for _ in range(max_batches):
+        rows = SPOOL.peek(SPOOL_BATCH_SIZE)
+        if not rows:
+            break
+        if TRANSPORT.supports("metrics_batch"):
+            # 404 here may just mean an older server, so only 401 drops the identity
+            r = IDENTITY.check(
+                TRANSPORT.post_json(f"/api/device/{device_id}/metrics/batch", [p for _, p in rows]),
+                not_found=False,
+            )
+            if r.status_code == 200:
+                SPOOL.ack(rows[-1][0])
+                sent += len(rows)
+                continue
+            if r.status_code not in (404, 405):
+                raise UploadFailed(f"Batch upload failed: HTTP {r.status_code}: {r.text}", r)
+            # Older server without the batch endpoint
+            TRANSPORT.mark_missing("metrics_batch")
+        for row_id, payload in rows:
+            r = IDENTITY.check(TRANSPORT.post_json(f"/api/device/{device_id}/metrics", payload))
+            if r.status_code != 200:
+                raise UploadFailed(f"Replay failed: HTTP {r.status_code}: {r.text}", r)
+            SPOOL.ack(row_id)
+            sent += 1
+    return sent
+
+# -------- Server Policy --------
+RESCHEDULE = threading.Event()  # Wakes the upload loop when its interval changes
+
+# Settings the server may override, as (type, minimum, maximum); bounds guard against typos
+POLICY_FIELDS = {
+    "upload_interval": (float, 5, 86400),
+    "sample_period": (float, 0.2, 300),
+    "top_processes": (int, 0, 100),
+    "bandwidth_probe_interval": (float, 0, 7 * 86400),  # 0 disables probing
+    "payload_format": (str, None, None),
+    "task_poll_min": (float, 1, 3600),
+    "task_poll_max": (float, 1, 86400),
+    "refresh": (float, 10, 86400),
+    "adaptive": (bool, None, None),
+}
+PAYLOAD_FORMATS = ("json", "delta")
+# Settings that must stay ordered, as (lower, higher), once the policy is merged over the defaults
+POLICY_ORDERED = (("task_poll_min", "task_poll_max"), ("sample_period", "upload_interval"))
+REQUIRED_COLLECTORS = {"rates"}  # collect_metrics cannot run without them
+
+class ServerPolicy:
+    """Settings fetched from the server with ETag revalidation and applied without a restart
+
+    Anything the policy leaves out keeps its .env / command-line value. The
+    last policy is cached on disk, so a restarted agent keeps, say, an
+    incident's slower upload interval before it reaches the server again.
+    """
+
+    def __init__(self, path, refresh=POLICY_REFRESH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.defaults = {
+            "upload_interval": 60,
+            "sample_period": SAMPLE_PERIOD,
+            "top_processes": TOP_PROCESSES,
+            "bandwidth_probe_interval": BANDWIDTH_PROBE_INTERVAL,
+            "payload_format": PAYLOAD_FORMAT,
+            "task_poll_min": TASK_POLL_MIN,
+            "task_poll_max": TASK_POLL_MAX,
+            "refresh": refresh,
+            "adaptive": ADAPTIVE_ENABLED,
+            "collectors": {name: collector.interval for name, collector in COLLECTORS.items()},
+        }
+        self.values = self.defaults
+        self.document = {}  # Validated server policy; empty means .env settings only
+        self.etag = None
+        self.wake = threading.Event()
+        self.stop_flag = threading.Event()
+        self.thread = None
+
+    def get(self, name):
+        return self.values[name]
+
+    @staticmethod
+    def validate(document):
+        """Keep known, well-typed, in-range fields; report and drop the rest"""
+        clean = {}
+        for name, value in document.items():
+            if name == "collectors" and isinstance(value, dict):
+                collectors = {}
+                for collector, setting in value.items():
+                    if collector not in COLLECTORS or (setting is False and collector in REQUIRED_COLLECTORS):
+                        print(f"ℹ️ Policy: ignoring collector setting {collector}={setting!r}")
+                    elif isinstance(setting, bool) or (isinstance(setting, (int, float)) and setting >= 0):
+                        collectors[collector] = setting
+                    else:
+                        print(f"ℹ️ Policy: ignoring collector setting {collector}={setting!r}")
+                clean[name] = collectors
+                continue
+            kind, low, high = POLICY_FIELDS.get(name, (None, None, None))
+            if kind is str and value in PAYLOAD_FORMATS:
+                clean[name] = value
+            elif kind is bool and isinstance(value, bool):
+                clean[name] = value
+            elif kind in (int, float) and isinstance(value, (int, float)) and not isinstance(value, bool):
+                clean[name] = kind(min(max(value, low), high))
+            else:
+                print(f"ℹ️ Policy: ignoring {name}={value!r}")
+        return clean
+
+    def conflicts(self, document):
+        """Ordered pairs a policy would invert, e.g. task_poll_min above task_poll_max"""
+        values = {**self.defaults, **document}
+        return [f"{low}={values[low]} > {high}={values[high]}"
+                for low, high in POLICY_ORDERED if values[low] > values[high]]
+
+    def _apply(self, document):
+        """Merge a validated policy over the defaults and push every changed setting live"""
+        global ENCODER
+        values = {**self.defaults, **document}
+        values["collectors"] = {**self.defaults["collectors"], **document.get("collectors", {})}
+        with self.lock:
+            old, self.values, self.document = self.values, values, document
+        changed = [name for name in values if values[name] != old[name]]
+        for name in changed:
+            value = values[name]
+            if name == "upload_interval":
+                RESCHEDULE.set()
+            elif name == "adaptive":
+                CADENCE.set_enabled(value)
+            elif name == "sample_period":
+                SAMPLER.period = value
+            elif name == "bandwidth_probe_interval":
+                BANDWIDTH.set_interval(value)
+            elif name == "payload_format":
+                ENCODER = DeltaEncoder() if value == "delta" else None
+            elif name == "task_poll_min":
+                TASK_MANAGER.poll_min = value
+            elif name == "task_poll_max":
+                TASK_MANAGER.poll_max = value
+            elif name == "collectors":
+                for collector_name, setting in value.items():
+                    collector = COLLECTORS[collector_name]
+                    collector.enabled = setting is not False
+                    collector.interval = (self.defaults["collectors"][collector_name]
+                                          if isinstance(setting, bool) else setting)
+        return changed
+
+    def _load(self):
+        """Cached policy from the last run, if it belongs to this device key"""
+        try:
+            cached = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return self.document
+        if cached.get("device_key") != IDENTITY.device_key:
+            return self.document
+        document = self.validate(cached.get("policy") or {})
+        if self.conflicts(document):
+            return self.document  # .env settings changed under it since it was saved
+        self.etag = cached.get("etag")
+        return document
+
+    def _save(self):
+        try:
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps({"device_key": IDENTITY.device_key, "etag": self.etag, "policy": self.document}))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"⨯ Could not save policy: {e}")
+
+    def fetch(self):
+        """Conditional GET of the policy; returns the settings that changed"""
+        device_id = IDENTITY.get_id()
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        r = IDENTITY.check(TRANSPORT.get(f"/api/device/{device_id}/policy", headers=headers), not_found=False)
+        if r.status_code == 304:
+            return []
+        if r.status_code == 404:
+            # No policy for this device (or an older server): back to .env settings
+            document, etag = {}, None
+        elif r.status_code == 200:
+            document, etag = self.validate(r.json()), r.headers.get("ETag")
+            conflicts = self.conflicts(document)
+            if conflicts:
+                print(f"⨯ Policy rejected, keeping the current one: {', '.join(conflicts)}")
+                return []
+        else:
+            raise Exception(f"HTTP {r.status_code}")
+        changed = self._apply(document)
+        if etag != self.etag or changed:
+            self.etag = etag
+            self._save()
+        if changed:
+            shown = {**self.values, "collectors": self.document.get("collectors", "defaults")}
+            print("✓ Policy applied: " + ", ".join(f"{name}={shown[name]}" for name in changed))
+            METRICS.inc("agent_policy_updates_total")
+        return changed
+
+    def hint(self, etag):
+        """The server advertised its current policy ETag (e.g. on an upload); refresh now if it moved"""
+        if etag and etag != self.etag:
+            self.wake.set()
+
+    def start(self, upload_interval):
+        """Apply the cached policy now and keep it fresh in the background"""
+        self.defaults = {**self.defaults, "upload_interval": upload_interval}
+        starting = POLICY_ENABLED and not self.thread
+        self._apply(self._load() if starting else self.document)
+        RESCHEDULE.clear()  # The caller reads the starting interval itself
+        if starting:
+            self.stop_flag.clear()
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_flag.set()
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _loop(self):
+        while not self.stop_flag.is_set():
+            if not BACKOFF.paused():
+                try:
+                    self.fetch()
+                except Exception as e:
+                    print(f"Policy refresh failed: {e}")
+            # Jittered, so a fleet does not revalidate in lockstep
+            self.wake.wait(self.get("refresh") * random.uniform(0.8, 1.2))
+            self.wake.clear()
+
+POLICY = ServerPolicy(POLICY_PATH)
+
+# -------- Adaptive Cadence --------
+# Per metric, the move away from its running mean that counts as activity; a spike must be twice that
+CADENCE_METRICS = {"cpu_percent": 10.0, "ram_percent": 3.0, "gpu_util": 10.0}
+
+def user_idle_seconds():
+    """Seconds since the last keyboard or mouse input; None where it cannot be read cheaply"""
+    if not win():
+        return None
+    import ctypes
+
+    class LASTINPUTINFO(ctypes.Structure):
+        _fields_ = [("cbSize", ctypes.c_uint), ("dwTime", ctypes.c_uint)]
+
+    info = LASTINPUTINFO(ctypes.sizeof(LASTINPUTINFO), 0)
+    if not ctypes.windll.user32.GetLastInputInfo(ctypes.byref(info)):
+        return None
+    return ((ctypes.windll.kernel32.GetTickCount() - info.dwTime) & 0xFFFFFFFF) / 1000
+
+def on_battery():
+    try:
+        battery = psutil.sensors_battery()
+    except Exception:
+        return False
+    return bool(battery and battery.power_plugged is False)
+
+class AdaptiveCadence:
+    """Chooses the upload interval: slower while the machine is idle, faster around spikes
+
+    Fed every sampler tick. An exponentially weighted mean and variance per
+    metric (about a minute of memory) gives a z-score for spikes in a few
+    float operations, so detection adds nothing measurable to a tick.
+    """
+
+    ALPHA = 2 / (60 + 1)
+    WARMUP = 30  # Ticks before the variance is trusted
+    SPIKE_TICKS = 2  # Consecutive outliers needed; one noisy reading is not a spike
+    AWAY_CHECK = 30  # Seconds between user-idle / battery checks
+
+    def __init__(self, enabled=ADAPTIVE_ENABLED):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.mode = "normal"
+        self.since = time.time()
+        self.mean = {}
+        self.var = {}
+        self.outliers = dict.fromkeys(CADENCE_METRICS, 0)
+        self.seen = 0
+        self.last_active = None
+        self.burst_start = self.burst_until = None
+        self.cooldown_until = 0.0
+        self.away_checked = None
+        self.away = None  # Why the user counts as away, or None
+        self.switches = collections.deque(maxlen=5)
+
+    def observe(self, rates, now=None):
+        """Update the detector with one sampler reading and switch mode if needed"""
+        if not self.enabled:
+            return
+        now = time.monotonic() if now is None else now
+        spike = None
+        active = False
+        for name, flat in CADENCE_METRICS.items():
+            x = rates.get(name)
+            mean = self.mean.get(name)
+            if x is None:
+                continue
+            if mean is None:
+                self.mean[name], self.var[name] = x, 0.0
+                continue
+            diff = x - mean
+            var = self.var[name]
+            active = active or abs(diff) > flat
+            # Only rises count: a drop is not an incident
+            if diff >= 2 * flat and self.seen >= self.WARMUP and diff * diff > ADAPTIVE_Z ** 2 * var:
+                self.outliers[name] += 1
+                if self.outliers[name] >= self.SPIKE_TICKS and not spike:
+                    spike = f"{name} {x:.0f} vs {mean:.0f}" + (f", z={diff / math.sqrt(var):.1f}" if var else "")
+            else:
+                self.outliers[name] = 0
+            increment = self.ALPHA * diff
+            self.mean[name] = mean + increment
+            self.var[name] = (1 - self.ALPHA) * (var + diff * increment)
+        self.seen += 1
+        if active or self.last_active is None:
+            self.last_active = now
+        with self.lock:
+            self._update(now, spike, active)
+
+    def _update(self, now, spike, active):
+        if self.mode == "burst" and now >= self.burst_until:
+            # A machine that kept spiking for the whole burst waits before the next one
+            capped = self.burst_until >= self.burst_start + ADAPTIVE_BURST_MAX
+            self.cooldown_until = now + ADAPTIVE_BURST_SECONDS if capped else now
+            self._switch("normal", "burst window over")
+        if spike and now >= self.cooldown_until:
+            if self.mode != "burst":
+                self.burst_start = now
+                self._switch("burst", spike)
+            self.burst_until = min(now + ADAPTIVE_BURST_SECONDS, self.burst_start + ADAPTIVE_BURST_MAX)
+        elif self.mode == "idle" and active:
+            self._switch("normal", "activity")
+        elif self.mode == "normal" and now - self.last_active >= ADAPTIVE_IDLE_AFTER and self._away(now):
+            self._switch("idle", f"flat for {now - self.last_active:.0f}s, {self.away}")
+
+    def _away(self, now):
+        """Whether the user is away (or on battery); rechecked every AWAY_CHECK seconds"""
+        if self.away_checked is None or now - self.away_checked >= self.AWAY_CHECK:
+            self.away_checked = now
+            idle = user_idle_seconds()
+            if on_battery():
+                self.away = "on battery"
+            elif idle is None:
+                # Linux and services have no input to read; idle them only where configured to
+                self.away = "no interactive user" if ADAPTIVE_HEADLESS_AWAY else None
+            elif idle >= ADAPTIVE_IDLE_AFTER:
+                self.away = f"no input for {idle:.0f}s"
+            else:
+                self.away = None
+        return self.away is not None
+
+    def _switch(self, mode, reason):
+        previous, self.mode, self.since = self.mode, mode, time.time()
+        self.switches.append({"at": self.since, "from": previous, "to": mode, "reason": reason})
+        print(f"ℹ️ Sampling {previous} → {mode} ({reason}), uploading every {self.interval():.0f}s")
+        METRICS.inc("agent_cadence_switches_total", mode=mode)
+        RESCHEDULE.set()
+
+    def set_enabled(self, enabled):
+        with self.lock:
+            self.enabled = enabled
+            if not enabled and self.mode != "normal":
+                self._switch("normal", "adaptive sampling disabled")
+
+    def interval(self, base=None):
+        """Upload interval for the current mode; base defaults to the policy's"""
+        base = POLICY.get("upload_interval") if base is None else base
+        if self.mode == "burst":
+            return min(base, ADAPTIVE_BURST_INTERVAL)
+        if self.mode == "idle":
+            return max(base, ADAPTIVE_IDLE_INTERVAL)
+        return base
+
+    def report(self):
+        """Mode and recent switches for the payload"""
+        return {
+            "mode": self.mode,
+            "interval_s": self.interval(),
+            "since": self.since,
+            "switches": list(self.switches),
+        }
+
+CADENCE = AdaptiveCadence()
+
+def send_metrics_with_backoff(interval=60, splay=STARTUP_SPLAY, until=None):
+    """Collect every interval; upload when the retry policy allows, spooling otherwise
+
+    Retries run on their own schedule: a failed upload is retried from the
+    spool when the backoff expires, without waiting for or delaying the next
+    sample. A server policy may replace interval at any time. Runs forever
+    unless given an until deadline (time.monotonic()), as benchmarks do.
+    """
     # Ensure we're registered
     if not ensure_device_registered():
         return
-    
-    while True:
-        try:
-            # Get device ID on first run
-            if device_id is None:
-                r = requests.get(f"{SERVER_URL}/api/device/me", headers=HEADERS)
-                if r.status_code == 200:
-                    device_id = r.json()["id"]
-                    print(f"✓ Connected as device #{device_id}")
+
+    # Local high-frequency sampling; each upload carries the window's rollups
+    SAMPLER.start()
+    PROCESSES.refresh()  # Primes per-process CPU counters before the first upload
+    GPU.start()
+    METRICS.gauge("agent_spool_depth", lambda: len(SPOOL))
+    METRICS.serve()
+
+    # Agents restarted together (updates, power cuts) should not call the server
+    # together: splay before the task stream, policy fetch and first upload.
+    # Spreading over a whole interval keeps their upload phases spread for good
+    time.sleep(random.uniform(0, interval if splay is None else splay))
+
+    BANDWIDTH.start()
+    # Tasks run on their own pool and poll thread, never inside this loop
+    TASK_MANAGER.start()
+    POLICY.start(interval)
+
+    last_sample = next_sample = time.monotonic()
+    while until is None or time.monotonic() < until:
+        payload = None
+        if time.monotonic() >= next_sample:
+            # Collect before talking to the server so outages still get recorded
+            try:
+                payload = collect_metrics()
+                record_history(payload)
+            except Exception as e:
+                # A local fault, not the server's: lose this sample, not the loop or the backoff state
+                print(f"⨯ Error collecting metrics: {e}")
+                METRICS.inc("agent_collect_failures_total")
+                payload = None
+            last_sample = time.monotonic()
+            next_sample = max(next_sample + CADENCE.interval(), last_sample)
+
+        if payload is None and not len(SPOOL):
+            pass  # Woken for a retry that a sample already covered
+        elif not BACKOFF.ready():
+            if payload is not None:
+                SPOOL.push(payload)
+                print(f"ℹ️ Server paused for {BACKOFF.remaining():.0f}s, spooled sample ({len(SPOOL)} waiting)")
+                METRICS.inc("agent_uploads_total", result="deferred")
+        else:
+            try:
+                device_id = IDENTITY.get_id()
+
+                if len(SPOOL):
+                    # Keep ordering: queue behind the backlog and replay in batches
+                    if payload is not None:
+                        SPOOL.push(payload)
+                    payload = None
+                    sent = drain_spool(device_id)
+                    encoder = ENCODER
+                    if encoder:
+                        encoder.reset()  # The server's latest sample is now a spooled one
+                    print(f"✓ Replayed {sent} spooled samples ({len(SPOOL)} left)")
                 else:
-                    raise Exception(f"Failed to get device ID: {r.status_code}")
-            
-            # Collect and send metrics
-            payload = collect_metrics()
-            r = requests.post(
-                f"{SERVER_URL}/api/device/{device_id}/metrics", 
-                headers=HEADERS, 
-                json=payload,
-                timeout=10
-            )
-            
-            if r.status_code == 200:
-                print(f"✓ Metrics sent ({r.json()['id']})")
-                delay = initial_delay  # Reset delay on success
-            else:
-                raise Exception(f"HTTP {r.status_code}: {r.text}")
-                
-        except Exception as e:
-            print(f"⨯ Error sending metrics: {e}")
-            delay = min(delay * 2, max_delay)  # Exponential backoff
-            
-        # Process any pending tasks
-        process_task_queue()
-        
-        time.sleep(delay)
+                    r = IDENTITY.check(upload_metrics(device_id, payload))
+                    if r.status_code != 200:
+                        raise UploadFailed(f"HTTP {r.status_code}: {r.text}", r)
+                    payload = None
+                    print(f"✓ Metrics sent ({r.json()['id']})")
+                    POLICY.hint(r.headers.get("X-Policy-ETag"))
+                BACKOFF.success()
+                METRICS.inc("agent_uploads_total", result="ok")
+
+            except Exception as e:
+                print(f"⨯ Error sending metrics: {e}")
+                if payload is not None:
+                    SPOOL.push(payload)
+                    print(f"  Spooled sample ({len(SPOOL)} waiting)")
+                wait = BACKOFF.failure(getattr(e, "retry_after", None))
+                print(f"  Next upload attempt in {wait:.0f}s")
+                METRICS.inc("agent_uploads_total", result="failed")
+        METRICS.set("agent_backoff_seconds", BACKOFF.remaining())
+        METRICS.set("agent_upload_interval_seconds", CADENCE.interval())
+
+        # Failures never slow down sampling; a pending retry may wake us before the next sample
+        wake = next_sample
+        if len(SPOOL) and BACKOFF.paused():
+            wake = min(wake, time.monotonic() + BACKOFF.remaining())
+        if until is not None:
+            wake = min(wake, until)
+        if RESCHEDULE.wait(max(0.0, wake - time.monotonic())):
+            # New upload interval (policy or cadence): count it from the last sample, not the old schedule
+            RESCHEDULE.clear()
+            next_sample = last_sample + CADENCE.interval()
 
 def main():
     parser = argparse.ArgumentParser(description="PC Health Maintainer Agent")
     parser.add_argument("--once", action="store_true", help="Collect & send a single metric")
     parser.add_argument("--interval", type=int, default=60, help="Collect every N seconds (default: 60)")
     parser.add_argument("--task", choices=list(TASKS.keys()), help="Run a single maintenance task locally (no server)")
+    parser.add_argument("--query", nargs="?", const="", metavar="METRIC",
+                        help="Print local history for metrics matching a glob, e.g. 'cpu_percent' or 'extra.disk_io.*' "
+                             "(no METRIC: list recorded metrics)")
+    parser.add_argument("--since", default="1h", help="Query start: 90s, 20m, 6h, 7d back from now, or an ISO time")
+    parser.add_argument("--until", default="now", help="Query end, same formats as --since (default: now)")
+    parser.add_argument("--step", help="Query bucket size, e.g. 5m (default: about 120 buckets)")
+    parser.add_argument("--json", action="store_true", help="Print --query results as JSON")
     args = parser.parse_args()
 
+    if args.query is not None:
+        return query_history(args.query, args.since, args.until, args.step, args.json)
+
     # Print startup info
     print(f"PC Health Maintainer Agent")
     print(f"Server: {SERVER_URL}")
@@ -637,30 +3370,40 @@ def main():
             if not ensure_device_registered():
                 return 1
                 
-            # Get device ID
-            r = requests.get(f"{SERVER_URL}/api/device/me", headers=HEADERS)
-            if r.status_code != 200:
-                print(f"Failed to get device ID: HTTP {r.status_code}")
-                return 1
-            device_id = r.json()["id"]
-            print(f"✓ Connected as device #{device_id}")
-            
+            # Device ID comes from the identity cache after the first run
+            device_id = IDENTITY.get_id()
+
+            # Nothing has sampled yet: CPU rates need a window, so take the
+            # first counters now and measure over one sample period
+            SAMPLER.prime()
+            PROCESSES.prime()
+            time.sleep(SAMPLE_PERIOD)
+
             # Collect and send metrics
             payload = collect_metrics()
+            record_history(payload)
             print(json.dumps(payload, indent=2))
-            r = requests.post(
-                f"{SERVER_URL}/api/device/{device_id}/metrics", 
-                headers=HEADERS, 
-                json=payload
-            )
+            try:
+                r = IDENTITY.check(upload_metrics(device_id, payload))
+            except requests.RequestException as e:
+                print(f"⨯ Failed to send metrics: {e}")
+                SPOOL.push(payload)
+                return 1
             if r.status_code == 200:
                 print(f"✓ Metrics sent (ID: {r.json()['id']})")
+                if len(SPOOL):
+                    # The sample is delivered; a backlog that won't drain is for the next run
+                    try:
+                        print(f"✓ Replayed {drain_spool(device_id)} spooled samples")
+                    except Exception as e:
+                        print(f"ℹ️ Could not replay spooled samples ({len(SPOOL)} waiting): {e}")
             else:
                 print(f"⨯ Failed to send metrics: HTTP {r.status_code}")
+                SPOOL.push(payload)
                 return 1
         else:
             print(f"Starting metrics collection (every {args.interval}s)")
-            send_metrics_with_backoff(initial_delay=args.interval)
+            send_metrics_with_backoff(interval=args.interval)
     except KeyboardInterrupt:
         print("\nExiting...")
     except Exception as e:
@@ -668,4 +3411,4 @@ def main():
         return 1
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,353 @@
+"""Fleet load generator: thousands of virtual agents in one process.
+
+Each virtual device speaks the agent's protocol (register, /api/device/me,
+metrics POST, task poll and updates) on a shared asyncio event loop. Without
+--server a local stub server is started, so this also runs in CI:
+
+    python loadgen.py --devices 2000 --duration 60
+    python loadgen.py --devices 500 --interval 30 --payloads payloads.jsonl -o load.json
+    python loadgen.py --server https://health.example.com --devices 200 --duration 300
+"""
+import argparse
+import asyncio
+import collections
+import gzip
+import json
+import os
+import platform
+import random
+import ssl
+import time
+from urllib.parse import urlencode, urlparse
+
+import agent
+from bench import StubServer, latency_stats
+
+
+# -------- Async HTTP --------
+class HttpPool:
+    """Minimal keep-alive HTTP/1.1 client; connections are shared by all virtual devices"""
+
+    def __init__(self, base_url, size=256, timeout=10):
+        url = urlparse(base_url)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.ssl = ssl.create_default_context() if url.scheme == "https" else None
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(size)
+        self.idle = []
+        self.opened = 0
+
+    async def _connect(self):
+        self.opened += 1
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    async def _exchange(self, conn, method, path, body, headers):
+        reader, writer = conn
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}",
+                 f"User-Agent: health-agent-loadgen/{agent.AGENT_VERSION}",
+                 f"Content-Length: {len(body)}"]
+        lines += [f"{k}: {v}" for k, v in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+
+        status = int((await reader.readuntil(b"\r\n")).split()[1])
+        fields = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            fields[name.strip().lower()] = value.strip()
+
+        if fields.get("transfer-encoding") == "chunked":
+            data = b""
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                data += chunk[:-2]
+        elif "content-length" in fields:
+            data = await reader.readexactly(int(fields["content-length"]))
+        else:
+            data = await reader.read()
+            fields["connection"] = "close"
+        return status, data, fields.get("connection", "").lower() != "close"
+
+    async def request(self, method, path, body=b"", headers=None):
+        """Send one request; returns (status, body bytes)"""
+        async with self.slots:
+            for attempt in range(2):
+                reused = bool(self.idle)
+                conn = self.idle.pop() if reused else await self._connect()
+                try:
+                    status, data, keep = await asyncio.wait_for(
+                        self._exchange(conn, method, path, body, headers or {}), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    conn[1].close()
+                    # The server may have closed an idle connection; retry once on a fresh one
+                    if reused and attempt == 0:
+                        continue
+                    raise e
+                except BaseException:
+                    conn[1].close()
+                    raise
+                if keep:
+                    self.idle.append(conn)
+                else:
+                    conn[1].close()
+                return status, data
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle.clear()
+
+
+# -------- Recording --------
+class LoadStats:
+    """Server latency per endpoint, and errors by endpoint and reason"""
+
+    def __init__(self):
+        self.latency = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.registered = 0
+        self.tasks_completed = 0
+        self.loop_lag = []
+
+    def report(self, elapsed):
+        endpoints = {}
+        for name, samples in sorted(self.latency.items()):
+            errors = sum(n for (endpoint, _), n in self.errors.items() if endpoint == name)
+            endpoints[name] = {
+                **latency_stats(samples),
+                "per_s": round(len(samples) / elapsed, 1),
+                "errors": errors,
+                "error_rate": round(errors / len(samples), 4),
+            }
+        total = sum(len(s) for s in self.latency.values())
+        lag = sorted(self.loop_lag) or [0]
+        return {
+            "elapsed_s": round(elapsed, 1),
+            "devices_registered": self.registered,
+            "requests": total,
+            "requests_per_s": round(total / elapsed, 1),
+            "error_rate": round(sum(self.errors.values()) / total, 4) if total else None,
+            "errors": {f"{endpoint} {reason}": n for (endpoint, reason), n in self.errors.most_common()},
+            "tasks_completed": self.tasks_completed,
+            "endpoints": endpoints,
+            # Scheduling lag of the generator itself; if high, the numbers above are client-bound
+            "loop_lag_ms": {"p95": round(agent.percentile(lag, 95) * 1000, 1),
+                            "max": round(lag[-1] * 1000, 1)},
+        }
+
+
+# -------- Payloads --------
+def record_payloads(n, period=1.0):
+    """Real collect_metrics payloads, a sampling period apart"""
+    agent.SAMPLER.start()
+    payloads = []
+    for _ in range(n):
+        time.sleep(period)
+        payloads.append(agent.collect_metrics())
+    agent.SAMPLER.stop()
+    return payloads
+
+
+def load_payloads(path, count):
+    """Replay payloads from a JSON-lines file, recording it first if it does not exist"""
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    payloads = record_payloads(count)
+    if path:
+        with open(path, "w") as f:
+            for payload in payloads:
+                f.write(json.dumps(payload) + "\n")
+    return payloads
+
+
+def encode_payloads(payloads, size=None, compress=agent.HTTP_GZIP):
+    """Pre-encode request bodies the way Transport.post_json would, optionally padded to size bytes"""
+    bodies = []
+    for payload in payloads:
+        body = json.dumps(payload, separators=(",", ":")).encode()
+        if size and len(body) < size:
+            padded = dict(payload, extra={**payload.get("extra", {}), "padding": ""})
+            filler = size - len(json.dumps(padded, separators=(",", ":")).encode())
+            padded["extra"]["padding"] = os.urandom(max(filler, 0) // 2 + 1).hex()[:max(filler, 0)]
+            body = json.dumps(padded, separators=(",", ":")).encode()
+        headers = {"Content-Type": "application/json"}
+        if compress and len(body) >= agent.Transport.GZIP_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+        bodies.append((body, headers))
+    return bodies
+
+
+def parse_mix(text):
+    """'disk_cleanup=2,flush_dns=1' -> {type: weight}"""
+    mix = {}
+    for item in filter(None, (p.strip() for p in text.split(","))):
+        name, _, weight = item.partition("=")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+# -------- Virtual Devices --------
+class VirtualDevice:
+    """One simulated agent: register, then upload and poll for tasks every interval"""
+
+    def __init__(self, n, pool, stats, bodies, opts):
+        self.n = n
+        self.pool = pool
+        self.stats = stats
+        self.bodies = bodies
+        self.opts = opts
+        self.key = None
+        self.id = None
+        self.running = set()
+
+    async def call(self, endpoint, method, path, body=b"", headers=None, ok=(200,)):
+        start = time.perf_counter()
+        try:
+            status, data = await self.pool.request(method, path, body, {**(headers or {}), "X-Device-Key": self.key})
+        except Exception as e:
+            self.stats.latency[endpoint].append(time.perf_counter() - start)
+            self.stats.errors[endpoint, type(e).__name__] += 1
+            return None
+        self.stats.latency[endpoint].append(time.perf_counter() - start)
+        if status not in ok:
+            self.stats.errors[endpoint, status] += 1
+            return None
+        return data
+
+    async def register(self):
+        form = urlencode({"name": f"loadgen-{self.n}"}).encode()
+        data = await self.call("register", "POST", "/api/register", form,
+                               {"Content-Type": "application/x-www-form-urlencoded"})
+        if data is None:
+            return False
+        self.key = json.loads(data)["device_key"]
+        data = await self.call("me", "GET", "/api/device/me")
+        if data is None:
+            return False
+        self.id = json.loads(data)["id"]
+        self.stats.registered += 1
+        return True
+
+    async def run_task(self, task):
+        path = f"/api/device/{self.id}/tasks/{task['id']}"
+        await self.call("task_update", "PUT", path, json.dumps({"status": "running"}).encode(),
+                        {"Content-Type": "application/json"})
+        await asyncio.sleep(random.expovariate(1 / self.opts.task_seconds))
+        result = {"status": "completed", "result": f"Simulated {task.get('type')} on loadgen-{self.n}"}
+        if await self.call("task_update", "PUT", path, json.dumps(result).encode(),
+                           {"Content-Type": "application/json"}) is not None:
+            self.stats.tasks_completed += 1
+
+    async def run(self, deadline):
+        opts = self.opts
+        # Devices boot at random points in the first interval, like a real fleet
+        await asyncio.sleep(random.uniform(0, opts.interval))
+        if not await self.register():
+            return
+        i = self.n
+        while time.monotonic() < deadline:
+            body, headers = self.bodies[i % len(self.bodies)]
+            i += 1
+            await self.call("metrics", "POST", f"/api/device/{self.id}/metrics", body, headers)
+            data = await self.call("tasks", "GET", f"/api/device/{self.id}/tasks?status=queued")
+            for task in json.loads(data) if data else []:
+                job = asyncio.ensure_future(self.run_task(task))
+                self.running.add(job)
+                job.add_done_callback(self.running.discard)
+            jitter = opts.jitter * opts.interval
+            await asyncio.sleep(max(0.0, opts.interval + random.uniform(-jitter, jitter)))
+        if self.running:
+            await asyncio.wait(self.running)
+
+
+async def queue_tasks(server, devices, mix, per_device_hour, deadline):
+    """Queue tasks on the stub at the configured rate, spread over registered devices"""
+    types, weights = list(mix), list(mix.values())
+    rate = len(devices) * per_device_hour / 3600
+    while time.monotonic() < deadline:
+        await asyncio.sleep(random.expovariate(rate) if rate else deadline - time.monotonic())
+        ready = [d.id for d in devices if d.id is not None]
+        if ready:
+            server.queue_task(random.choices(types, weights)[0], device_id=random.choice(ready))
+
+
+async def watch_loop_lag(stats, deadline, period=0.1):
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        await asyncio.sleep(period)
+        stats.loop_lag.append(max(0.0, time.monotonic() - start - period))
+
+
+async def run_fleet(base_url, opts, bodies, server=None):
+    stats = LoadStats()
+    pool = HttpPool(base_url, size=opts.connections, timeout=opts.timeout)
+    devices = [VirtualDevice(n, pool, stats, bodies, opts) for n in range(opts.devices)]
+    start = time.monotonic()
+    deadline = start + opts.duration
+    jobs = [d.run(deadline) for d in devices] + [watch_loop_lag(stats, deadline)]
+    if server is not None and opts.task_rate:
+        jobs.append(queue_tasks(server, devices, parse_mix(opts.task_mix), opts.task_rate, deadline))
+    await asyncio.gather(*jobs)
+    pool.close()
+    return stats.report(time.monotonic() - start), pool.opened
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of health agents against a server")
+    parser.add_argument("--server", help="Server URL (default: start a local stub server)")
+    parser.add_argument("--devices", type=int, default=1000, help="Virtual devices to run")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to run for")
+    parser.add_argument("--interval", type=float, default=10, help="Seconds between each device's uploads")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Interval jitter, as a fraction of it")
+    parser.add_argument("--payloads", help="JSON-lines file of collect_metrics payloads to replay "
+                                           "(recorded here if missing)")
+    parser.add_argument("--payload-bytes", type=int, help="Pad payloads to this many bytes before compression")
+    parser.add_argument("--no-gzip", action="store_true", help="Send uncompressed bodies")
+    parser.add_argument("--task-mix", default=",".join(agent.TASKS),
+                        help="Task types and weights queued on the stub, e.g. disk_cleanup=3,flush_dns=1")
+    parser.add_argument("--task-rate", type=float, default=6, help="Tasks per device per hour (stub only)")
+    parser.add_argument("--task-seconds", type=float, default=2, help="Mean simulated task duration")
+    parser.add_argument("--connections", type=int, default=256, help="Maximum concurrent connections")
+    parser.add_argument("--timeout", type=float, default=10, help="Per-request timeout in seconds")
+    parser.add_argument("-o", "--output", help="Write results to this JSON file")
+    opts = parser.parse_args()
+
+    payloads = load_payloads(opts.payloads, count=5)
+    bodies = encode_payloads(payloads, opts.payload_bytes, compress=not opts.no_gzip)
+    print(f"▶️ {opts.devices} devices, {opts.interval}s interval, {len(bodies)} payloads "
+          f"of ~{sum(len(b) for b, _ in bodies) // len(bodies)} bytes on the wire")
+
+    if opts.server:
+        results, connections = asyncio.run(run_fleet(opts.server, opts, bodies))
+    else:
+        with StubServer(task_stream=False) as server:
+            results, connections = asyncio.run(run_fleet(server.url, opts, bodies, server))
+    results["connections_opened"] = connections
+
+    report = {
+        "meta": {
+            "timestamp": time.time(),
+            "agent_version": agent.AGENT_VERSION,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "options": vars(opts),
+        },
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()